@@ -14,5 +14,5 @@ SANDBOX_BIN = SANDBOX_PATH / "bin"
 # Define the kernel workspace path
 KERNEL_PATH = SANDBOX_PATH / "kernel"
 
-# Ensure the sandbox directory exists
-SANDBOX_PATH.mkdir(parents=True, exist_ok=True)
+# The sandbox directory is created by whatever first writes into it, keeping
+# the package import free of filesystem side effects
@@ -2,16 +2,25 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+from pathlib import Path
 
-from patchwise import SANDBOX_PATH
+from patchwise import PACKAGE_NAME, SANDBOX_PATH
 
-LOG_PATH = os.path.join(SANDBOX_PATH, f"{__name__.split('.')[0]}.log")
+LOG_PATH = os.path.join(SANDBOX_PATH, f"{PACKAGE_NAME}.log")
+LOG_FORMAT = (
+    "%(asctime)s %(levelname).1s %(name)s %(filename)s#%(lineno)d: %(message)s"
+)
+LOG_DATE_FORMAT = "%H:%M:%S"
 
 # === Global logging config ===
 ENABLE_LOG_COLORS = True  # Set to False to disable colored logs in the stream handler
 FILE_HANDLER_LOG_LEVEL = logging.DEBUG  # Default log level for file handler
+FILE_HANDLER_BUFFER_SIZE = 128 * 1024  # Write buffer size of the log file
 
 # ANSI color codes
 RESET = "\033[0m"
@@ -23,57 +32,113 @@ BOLD = "\033[1m"
 
 
 class ColorFormatter(logging.Formatter):
+    # levelno -> (header color, header reset, message reset)
+    LEVEL_COLORS = {
+        logging.CRITICAL: (f"{BOLD}{RED}", "", RESET),
+        logging.ERROR: (f"{BOLD}{RED}", "", RESET),
+        logging.WARNING: (f"{BOLD}{YELLOW}", "", RESET),
+        logging.INFO: (CYAN, RESET, ""),
+        logging.DEBUG: (CYAN, RESET, ""),
+    }
+
+    def __init__(self, *args, base: logging.Formatter | None = None, **kwargs):
+        if base is None:
+            super().__init__(*args, **kwargs)
+        else:
+            # Reuse the already parsed and validated style of base
+            self._style = base._style
+            self._fmt = base._fmt
+            self.datefmt = base.datefmt
+
     def format(self, record):
         msg = super().format(record)
-        if not ENABLE_LOG_COLORS:
+        colors = self.LEVEL_COLORS.get(record.levelno)
+        if colors is None:
             return msg
 
         # Color everything up to and including the first ": "
-        split_idx = msg.find(": ")
-        if split_idx != -1:
-            header = msg[: split_idx + 2]
-            message = msg[split_idx + 2 :]
-        else:
+        header, sep, message = msg.partition(": ")
+        if not sep:
             return msg
 
-        if record.levelno >= logging.ERROR:
-            return f"{BOLD}{RED}{header}{message}{RESET}"
-        elif record.levelno == logging.WARNING:
-            return f"{BOLD}{YELLOW}{header}{message}{RESET}"
-        elif record.levelno in (logging.INFO, logging.DEBUG):
-            return f"{CYAN}{header}{RESET}{message}"
+        header_color, header_reset, message_reset = colors
+        return f"{header_color}{header}{sep}{header_reset}{message}{message_reset}"
 
-        else:
-            return msg
+
+class BufferedFileHandler(logging.FileHandler):
+    """
+    FileHandler that writes through a large buffer instead of flushing after
+    every record. The buffer is flushed for ERROR and above records and when
+    the handler is flushed or closed.
+    """
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=FILE_HANDLER_BUFFER_SIZE,
+            encoding=self.encoding,
+            errors=self.errors,
+        )
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.ERROR:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
 
 
 def setup_logger(log_file: str = LOG_PATH, log_level: str = "INFO"):
     """
     Sets up the logger with the specified log file and log level.
     """
-    format = "%(asctime)s %(levelname).1s %(name)s %(filename)s#%(lineno)d: %(message)s"
-    file_handler = logging.FileHandler(log_file, mode="w")
+    base_formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    file_handler = BufferedFileHandler(log_file, mode="w")
     file_handler.setLevel(FILE_HANDLER_LOG_LEVEL)  # Use global default
-    file_handler.setFormatter(logging.Formatter(format, datefmt="%H:%M:%S"))
+    file_handler.setFormatter(base_formatter)
     stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(ColorFormatter(format, datefmt="%H:%M:%S"))
+    # Only color a terminal, not redirected output such as CI logs
+    if ENABLE_LOG_COLORS and stream_handler.stream.isatty():
+        stream_handler.setFormatter(ColorFormatter(base=base_formatter))
+    else:
+        stream_handler.setFormatter(base_formatter)
     # Set stream_handler level based on user input
     stream_handler.setLevel(log_level)
+    # Log calls only enqueue the record; a background listener thread does
+    # the formatting and the blocking writes to the real handlers
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    # Drain the queue before logging.shutdown() flushes and closes the handlers
+    atexit.register(listener.stop)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Keep basicConfig from applying its default format before the real
+    # handlers apply theirs
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
     logging.basicConfig(
         level=logging.ERROR,
-        handlers=[file_handler, stream_handler],
+        handlers=[queue_handler],
     )
-    logging.getLogger(__name__.split(".")[0]).setLevel(log_level)
+    logging.getLogger(PACKAGE_NAME).setLevel(log_level)
 
 
 def add_logging_arguments(
     parser_or_group: argparse.ArgumentParser | argparse._ArgumentGroup,
-    config: dict
+    config: dict | None = None,
 ):
     parser_or_group.add_argument(
         "--log-level",
         choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"),
-        default=config["log_level"],
+        default=(config or {}).get("log_level", "INFO"),
         help="Set the logging level. (default: %(default)s)",
     )
     parser_or_group.add_argument(
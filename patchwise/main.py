@@ -2,30 +2,37 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
+import concurrent.futures
+import functools
 import logging
+import queue
+import sys
 from pathlib import Path
-
-from git import Repo
-from git.objects.commit import Commit
-from rich_argparse import RichHelpFormatter
+from typing import TYPE_CHECKING
 
 from .logger_setup import add_logging_arguments, setup_logger
-from .patch_review import (
-    add_review_arguments,
-    get_selected_reviews_from_args,
-    install_missing_dependencies,
-    review_patch,
-)
-from .patch_review.ai_review.ai_review import add_ai_arguments, apply_ai_args
-from .patch_review.kernel_tree import create_git_worktree
-from .patch_review.patch_review import PATCH_PATH
 from .utils.config import parse_config
 
+if TYPE_CHECKING:
+    from git import Repo
+    from git.objects.commit import Commit
+
 logger = logging.getLogger(__name__)
 
 
-def parse_args(config: dict) -> argparse.Namespace:
-    parser = argparse.ArgumentParser(formatter_class=RichHelpFormatter)
+@functools.lru_cache(maxsize=2)
+def build_parser(
+    formatter_class: type[argparse.HelpFormatter] = argparse.HelpFormatter,
+) -> argparse.ArgumentParser:
+    """
+    Builds the argument parser. The parser only depends on the formatter and
+    the review registry, so it is built once per process; defaults that can
+    change between invocations are applied by parse_args.
+    """
+    from .patch_review import add_review_arguments
+    from .patch_review.ai_review.ai_review import add_ai_arguments
+
+    parser = argparse.ArgumentParser(formatter_class=formatter_class)
 
     review_group = parser.add_argument_group("Patch Review Options")
 
@@ -37,22 +44,46 @@ def parse_args(config: dict) -> argparse.Namespace:
     )
     review_group.add_argument(
         "--repo-path",
-        default=str(Path.cwd()),
+        default=None,
         help="Path to the kernel workspace containing the patch(es) to review. Uses CWD if not specified. (default: %(default)s)",
     )
 
+    review_group.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of commits to review concurrently, each in its own kernel worktree. (default: %(default)s)",
+    )
+
     add_review_arguments(review_group)
 
     ai_group = parser.add_argument_group("AI Review Options")
     add_ai_arguments(ai_group)
 
     logging_group = parser.add_argument_group("Logging Options")
-    add_logging_arguments(logging_group, config)
+    add_logging_arguments(logging_group)
+
+    return parser
+
+
+def parse_args(config: dict) -> argparse.Namespace:
+    # add_argument() builds a formatter to validate each argument, so only
+    # pull in rich when the help is actually going to be rendered
+    formatter_class = argparse.HelpFormatter
+    if any(arg in ("-h", "--help") for arg in sys.argv[1:]):
+        from rich_argparse import RichHelpFormatter
+
+        formatter_class = RichHelpFormatter
+
+    parser = build_parser(formatter_class)
+    parser.set_defaults(repo_path=str(Path.cwd()), log_level=config["log_level"])
 
     return parser.parse_args()
 
 
-def get_patches(repo: Repo, commits: list[Commit]):
+def get_patches(repo: "Repo", commits: list["Commit"]):
+    from .patch_review.patch_review import PATCH_PATH
+
     dest_dir = PATCH_PATH / "user"
     dest_dir.mkdir(parents=True, exist_ok=True)
     for idx, commit in enumerate(commits, 1):
@@ -62,23 +93,27 @@ def get_patches(repo: Repo, commits: list[Commit]):
         patch_file.write_text(diff)
 
 
-def get_commits(repo: Repo, commits: list[str]) -> list[Commit]:
+def _get_commits_range(repo: "Repo", commit_range: str) -> list["Commit"]:
+    """
+    Return all commits in a "sha1..sha2" range (inclusive of sha1, exclusive of sha2, like git log).
+    """
+    # Walks the range in a single pass, yielding commits in reverse
+    # chronological order like git rev-list
+    return list(repo.iter_commits(commit_range))
+
+
+def get_commits(repo: "Repo", commits: list[str]) -> list["Commit"]:
     """
     Given a repo and a list of commit refs or a commit range, return a list of Commit objects.
     - If commits is a list of refs (e.g., ["HEAD", "abc123"]) return those commits.
-    - If commits is a single string in range format (e.g., "sha1..sha2"), return all commits in that range (inclusive of sha1, exclusive of sha2, like git log).
+    - If commits holds a single ref in range format (e.g., ["sha1..sha2"]), return all commits in that range (inclusive of sha1, exclusive of sha2, like git log).
     """
-    if isinstance(commits, str):
-        commits = [commits]
     if len(commits) == 1 and ".." in commits[0]:
-        # Range mode
-        commit_range = commits[0]
-        # git rev-list returns commits in reverse chronological order
-        commit_shas = list(repo.git.rev_list(commit_range).splitlines())
-        return [repo.commit(sha) for sha in commit_shas]
-    else:
-        # List of refs/SHAs
-        return [repo.commit(ref) for ref in commits]
+        return _get_commits_range(repo, commits[0])
+
+    # List of refs/SHAs, resolving duplicate refs only once
+    resolve_commit = functools.lru_cache(maxsize=None)(repo.commit)
+    return [resolve_commit(ref) for ref in commits]
 
 
 def main():
@@ -88,21 +123,69 @@ def main():
 
     setup_logger(log_file=args.log_file, log_level=args.log_level)
 
+    # Deferred until after argument parsing so that --help does not pay for
+    # GitPython and the review plugins
+    from .patch_review import apply_review_args, get_selected_reviews_from_args
+    from .patch_review.ai_review.ai_review import apply_ai_args
+
+    apply_review_args(args)
     apply_ai_args(args)
 
     reviews = get_selected_reviews_from_args(args)
 
     if args.install:
+        from .patch_review import install_missing_dependencies
+
         install_missing_dependencies(reviews)
         return
 
+    from git import Repo
+
+    from .patch_review import review_patch
+    from .patch_review.kernel_tree import create_git_worktree, create_worker_worktrees
+    from .patch_review.patch_review import get_kernel_repo
+
     repo = Repo(args.repo_path)
     commits = get_commits(repo, args.commits)
     create_git_worktree(repo)
 
-    for commit in commits:
-        logger.info(f"Reviewing commit {commit.hexsha}...")
-        review_patch(reviews, commit)
+    # A commit reviewed twice at once would build twice in its build directory
+    if args.jobs > 1:
+        commits = list({commit.hexsha: commit for commit in commits}.values())
+
+    jobs = max(1, min(args.jobs, len(commits)))
+    if jobs == 1:
+        for commit in commits:
+            logger.info(f"Reviewing commit {commit.hexsha}...")
+            review_patch(reviews, commit, parallel=args.parallel_reviews)
+        return
+
+    # Each worker checks out and builds in a worktree of its own
+    free_worktrees: queue.SimpleQueue[Path] = queue.SimpleQueue()
+    for worktree_path in create_worker_worktrees(repo, jobs):
+        free_worktrees.put(worktree_path)
+
+    def _review_commit(commit: "Commit") -> None:
+        worktree_path = free_worktrees.get()
+        try:
+            # GitPython's object reader is not thread safe, so every worker
+            # loads the commit through the Repo of its own worktree rather
+            # than the one shared with the other workers
+            commit = get_kernel_repo(worktree_path).commit(commit.hexsha)
+            logger.info(f"Reviewing commit {commit.hexsha} in {worktree_path}...")
+            review_patch(
+                reviews,
+                commit,
+                parallel=args.parallel_reviews,
+                kernel_path=worktree_path,
+            )
+        finally:
+            free_worktrees.put(worktree_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Consume the results so that a failing review is raised here
+        for _ in executor.map(_review_commit, commits):
+            pass
 
 
 if __name__ == "__main__":
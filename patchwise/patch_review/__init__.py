@@ -2,42 +2,43 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
-
-# Automatically import all patch review modules so all @register_patch_review classes are registered
-import importlib
+import concurrent.futures
+import functools
 import logging
-import pkgutil
-from typing import Iterable
-
-from git.objects.commit import Commit
-
-from . import ai_review, static_analysis
-
-# Import all modules in static_analysis subpackage
-for _, modname, ispkg in pkgutil.iter_modules(static_analysis.__path__):
-    if not ispkg:
-        importlib.import_module(f"{__name__}.static_analysis.{modname}")
-
-# Import all modules in ai_review subpackage
-for _, modname, ispkg in pkgutil.iter_modules(ai_review.__path__):
-    if not ispkg:
-        importlib.import_module(f"{__name__}.ai_review.{modname}")
-
-from patchwise.patch_review.decorators import (
-    AVAILABLE_PATCH_REVIEWS,
-    LLM_REVIEWS,
-    LONG_REVIEWS,
-    SHORT_REVIEWS,
-    STATIC_ANALYSIS_REVIEWS,
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable
+
+from patchwise import KERNEL_PATH
+
+from .registry import (
+    AVAILABLE_REVIEW_NAMES,
+    LLM_REVIEW_NAMES,
+    LONG_REVIEW_NAMES,
+    REVIEW_MODULES,
+    SHORT_REVIEW_NAMES,
+    STATIC_ANALYSIS_REVIEW_NAMES,
+    get_review_class,
 )
 
-from .patch_review import PatchReview
+if TYPE_CHECKING:
+    from git.objects.commit import Commit
+
+    from .patch_review import PatchReview
 
 logger = logging.getLogger(__name__)
 
+# args attribute -> review names selected by that group flag
+_REVIEW_GROUPS: dict[str, frozenset[str]] = {
+    "all_reviews": AVAILABLE_REVIEW_NAMES,
+    "llm_reviews": LLM_REVIEW_NAMES,
+    "static_analysis_reviews": STATIC_ANALYSIS_REVIEW_NAMES,
+    "short_reviews": SHORT_REVIEW_NAMES,
+    "long_reviews": LONG_REVIEW_NAMES,
+}
+
 
 class PatchReviewResults:
-    def __init__(self, commit: Commit):
+    def __init__(self, commit: "Commit"):
         self.commit = commit
         self.results: dict[str, str] = {}
 
@@ -45,36 +46,91 @@ class PatchReviewResults:
         return f"PatchReviewResults(commit={self.commit}, results={self.results})"
 
 
+def _run_review(review: "PatchReview") -> str:
+    review_name = review.__class__.__name__
+    logger.debug(f"Running review: {review_name}")
+    result = review.run()
+    if result:
+        logger.info(f"{review_name} result:\n{result}")
+    else:
+        logger.info(f"{review_name} found no issues")
+    return result
+
+
 def run_patch_review(
-    selected_reviews: list[type[PatchReview]], commit: Commit
+    selected_reviews: list[type["PatchReview"]],
+    commit: "Commit",
+    parallel: bool = False,
+    kernel_path: Path = KERNEL_PATH,
 ) -> PatchReviewResults:
     output = PatchReviewResults(commit)
 
-    for selected_review in selected_reviews:
-        logger.debug(f"Initializing review: {selected_review.__name__}")
-        cur_review = selected_review(commit)
-
-        logger.debug(f"Running review: {selected_review.__name__}")
-        result = cur_review.run()
-        if result:
-            logger.info(f"{selected_review.__name__} result:\n{result}")
-        else:
-            logger.info(f"{selected_review.__name__} found no issues")
+    # Reviews are always initialized one at a time since that applies their
+    # patches to the shared kernel tree. In parallel mode, reviews whose run()
+    # does not touch the tree are handed to a thread pool so that they overlap
+    # with the remaining reviews.
+    offloadable = [cls for cls in selected_reviews if cls.TREE_INDEPENDENT_RUN]
+    executor = (
+        concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(offloadable)))
+        if parallel and offloadable
+        else None
+    )
 
-        output.results[selected_review.__name__] = result
+    results: dict[str, str | concurrent.futures.Future[str]] = {}
+    try:
+        for selected_review in selected_reviews:
+            logger.debug(f"Initializing review: {selected_review.__name__}")
+            cur_review = selected_review(commit, kernel_path=kernel_path)
+
+            if executor is not None and selected_review.TREE_INDEPENDENT_RUN:
+                results[selected_review.__name__] = executor.submit(
+                    _run_review, cur_review
+                )
+            else:
+                results[selected_review.__name__] = _run_review(cur_review)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    for review_name, result in results.items():
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+        output.results[review_name] = result
 
     return output
 
 
-def review_patch(reviews: set[str], commit: Commit) -> PatchReviewResults:
-    all_reviews = {cls.__name__: cls for cls in AVAILABLE_PATCH_REVIEWS}
-    selected_reviews = [all_reviews[name] for name in reviews if name in all_reviews]
+@functools.cache
+def _reviews_by_lower_name() -> dict[str, str]:
+    """Maps lowercase review names to their canonical names"""
+    return {name.lower(): name for name in AVAILABLE_REVIEW_NAMES}
+
+
+@functools.cache
+def _sorted_review_names() -> tuple[str, ...]:
+    return tuple(sorted(AVAILABLE_REVIEW_NAMES))
+
+
+def _get_review_classes(reviews: Iterable[str]) -> list[type["PatchReview"]]:
+    """Resolves review names to classes, importing only the selected reviews"""
+    return [get_review_class(name) for name in reviews if name in REVIEW_MODULES]
+
+
+def review_patch(
+    reviews: set[str],
+    commit: "Commit",
+    parallel: bool = False,
+    kernel_path: Path = KERNEL_PATH,
+) -> PatchReviewResults:
+    selected_reviews = _get_review_classes(reviews)
 
     for review_cls in selected_reviews:
         logger.debug(f"Verifying dependencies for: {review_cls.__name__}")
         review_cls.verify_dependencies()
 
-    results = run_patch_review(selected_reviews, commit)
+    results = run_patch_review(
+        selected_reviews, commit, parallel=parallel, kernel_path=kernel_path
+    )
 
     return results
 
@@ -83,8 +139,7 @@ def install_missing_dependencies(reviews: set[str]) -> None:
     """
     Install missing dependencies for the specified reviews.
     """
-    all_reviews = {cls.__name__: cls for cls in AVAILABLE_PATCH_REVIEWS}
-    selected_reviews = [all_reviews[name] for name in reviews if name in all_reviews]
+    selected_reviews = _get_review_classes(reviews)
 
     for review_cls in selected_reviews:
         logger.info(f"Installing dependencies for: {review_cls.__name__}")
@@ -93,20 +148,18 @@ def install_missing_dependencies(reviews: set[str]) -> None:
     logger.info("All specified reviews' dependencies are installed.")
 
 
-def _review_list_str(reviews: Iterable[type[PatchReview]]):
+def _review_list_str(review_names: Iterable[str]):
     """Helper to format review names for help messages"""
-    return ", ".join(sorted({cls.__name__ for cls in reviews})) or "(none)"
+    return ", ".join(sorted(set(review_names))) or "(none)"
 
 
 def add_review_arguments(
     parser_or_group: argparse.ArgumentParser | argparse._ArgumentGroup,
 ):
     # Case-insensitive review name handling
-    available_review_names = {
-        cls.__name__.lower(): cls.__name__ for cls in AVAILABLE_PATCH_REVIEWS
-    }
+    available_review_names = _reviews_by_lower_name()
     # For display in help messages
-    available_review_choices = sorted([cls.__name__ for cls in AVAILABLE_PATCH_REVIEWS])
+    available_review_choices = list(_sorted_review_names())
 
     def _case_insensitive_review(review_name: str) -> str:
         lower_name = review_name.lower()
@@ -130,7 +183,19 @@ def add_review_arguments(
     parser_or_group.add_argument(
         "--short-reviews",
         action="store_true",
-        help=f"Run only short reviews: [`{_review_list_str(SHORT_REVIEWS)}`]. Overrides --reviews.",
+        help=f"Run only short reviews: [`{_review_list_str(SHORT_REVIEW_NAMES)}`]. Overrides --reviews.",
+    )
+
+    parser_or_group.add_argument(
+        "--parallel-reviews",
+        action="store_true",
+        help="Run reviews that do not need the kernel tree after setup (e.g. LLM reviews) concurrently with the other reviews.",
+    )
+
+    parser_or_group.add_argument(
+        "--no-ccache",
+        action="store_true",
+        help="Do not compile through ccache in static analysis builds, even if it is installed.",
     )
 
     parser_or_group.add_argument(
@@ -142,22 +207,25 @@ def add_review_arguments(
     return parser_or_group
 
 
+def apply_review_args(args: argparse.Namespace) -> None:
+    """
+    Applies review related arguments to the review classes.
+    This function is called after parsing command line arguments.
+    """
+    if args.no_ccache:
+        from .static_analysis.static_analysis import StaticAnalysis
+
+        StaticAnalysis.use_ccache = False
+
+
 def get_selected_reviews_from_args(args: argparse.Namespace) -> set[str]:
     """
     Given parsed args, return the set of review class names to run.
     This logic is shared by all entry points.
     """
-    group_sets: list[set[str]] = []
-    if getattr(args, "all_reviews", False):
-        group_sets.append(set(cls.__name__ for cls in AVAILABLE_PATCH_REVIEWS))
-    if getattr(args, "llm_reviews", False):
-        group_sets.append(set(cls.__name__ for cls in LLM_REVIEWS))
-    if getattr(args, "static_analysis_reviews", False):
-        group_sets.append(set(cls.__name__ for cls in STATIC_ANALYSIS_REVIEWS))
-    if getattr(args, "short_reviews", False):
-        group_sets.append(set(cls.__name__ for cls in SHORT_REVIEWS))
-    if getattr(args, "long_reviews", False):
-        group_sets.append(set(cls.__name__ for cls in LONG_REVIEWS))
+    group_sets = [
+        names for group, names in _REVIEW_GROUPS.items() if getattr(args, group, False)
+    ]
 
     explicit_reviews: set[str] = (
         set(args.reviews) if hasattr(args, "reviews") and args.reviews else set()
@@ -1,21 +1,77 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
+import bisect
+import codecs
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import json
+import logging
 import os
 import re
+import select
+import shutil
+import sqlite3
 import subprocess
 import threading
-import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 from patchwise import KERNEL_PATH, SANDBOX_PATH
 from patchwise.patch_review.decorators import register_llm_review, register_long_review
-from patchwise.patch_review.patch_review import Dependency
+from patchwise.patch_review.patch_review import NPROC, LLVMDependency
 
 from .ai_review import AiReview
 
+try:
+    import orjson
+
+    # orjson serializes straight to bytes and parses bytes without decoding
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    _json_loads = json.loads
+
+# Type words starting a declaration, at the start of the line or after "(",
+# ",", "{" or ";", then the declared identifier, either after whitespace or
+# "*" bound to it, and the end of a declarator. E.g. "int ret;", "struct
+# device *dev)" or "u8 buf[4]", but not "b * SZ_4K)" or "*val = ...". Group 1
+# is the word right before the identifier, group 2 the identifier. The end
+# of the declarator is not consumed, so "int a, char *b" matches twice.
+_LOCAL_DECL_RE = re.compile(
+    r"(?:^|[(,{;])\s*(?:[_a-zA-Z]\w*\s+)*([_a-zA-Z]\w*)"
+    r"(?:\s*\*+|\s+)([_a-zA-Z]\w*)\s*(?=[=;,\[)])"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def path_to_uri(path: str) -> str:
+    """Convert an absolute path to a file:// URI."""
+    return f"file://{path}"
+
+
+@functools.lru_cache(maxsize=None)
+def uri_to_path(uri: str) -> str:
+    """Convert a file:// URI to an absolute path."""
+    return uri.removeprefix("file://")
+
+
+@functools.cache
+def _load_kernel_coding_style(coding_style_path: str) -> str:
+    """
+    Read the coding style guidelines once per process. A failed read raises,
+    and is therefore not cached, so that it is retried by the next review.
+    """
+    with open(coding_style_path, "r") as f:
+        return f.read()
+
 
 @dataclass
 class LSPLocation:
@@ -42,29 +98,78 @@ class AiCodeReview(AiReview):
     """AI-powered code review for Linux kernel patches using LSP and clangd."""
 
     DEPENDENCIES = getattr(AiReview, "DEPENDENCIES", []) + [
-        Dependency(
+        LLVMDependency(
             name="clangd",
             min_version="14.0.0",
             max_version="20.0.0",
         ),
-        Dependency(
+        LLVMDependency(
             name="clang",
             min_version="14.0.0",
             max_version="20.0.0",
         ),
     ]
 
+    # Passed to every make invocation, part of the compile_commands.json key
+    MAKE_VARIABLES = ["ARCH=arm64", "LLVM=1"]
+
     # LSP Configuration
     MAX_GAP = 5
 
     # File processing
     IDENTIFIER_PATTERN = r"\b[_a-zA-Z][_a-zA-Z0-9]*\b"
-
-    # LSP message IDs
+    _IDENT_RE = re.compile(IDENTIFIER_PATTERN)
+    # Files clangd can parse, everything else in a diff is skipped
+    SOURCE_EXTENSIONS = frozenset({".c", ".h", ".cc", ".cpp"})
+    # Identifiers that never have a definition worth looking up
+    SKIPPED_IDENTIFIERS = frozenset("""
+        auto break case char const continue default do double else enum extern
+        float for goto if inline int long register restrict return short signed
+        sizeof static struct switch typedef union unsigned void volatile while
+        _Bool bool true false NULL
+        """.split())
+    # Words that can directly precede an identifier without declaring it
+    NON_DECLARING_WORDS = frozenset(
+        "return case goto sizeof else do struct enum union typeof".split()
+    )
+    # LSP SymbolKind values of function definitions
+    FUNCTION_SYMBOL_KINDS = frozenset({6, 12})
+
+    # Occurrences of an identifier in a file tried before giving up on it
+    MAX_IDENTIFIER_ATTEMPTS = 3
+
+    # LSP message IDs, requests after initialize are numbered sequentially
     INIT_MSG_ID = 1
-    DEFINITION_MSG_ID = 2
-    SYMBOL_MSG_ID = 3
-    DOC_SYMBOL_MSG_ID = 100
+    # Requests in flight before their responses are drained, bounded so that
+    # clangd never blocks on a full stdout pipe while we are still writing
+    MAX_PIPELINED_REQUESTS = 64
+    # Upper bound on concurrent clangd processes, each background-indexes the
+    # whole compile database so they are far heavier than a CPU's worth of work
+    MAX_LSP_WORKERS = 4
+    # Seconds to wait for clangd to send anything before giving up
+    LSP_READ_TIMEOUT = 300
+    # Bytes read from clangd's stdout at once, usually several whole messages
+    LSP_READ_SIZE = 1 << 20
+    # Source files kept in memory by _read_file_safely, least recently used evicted first
+    MAX_CACHED_FILES = 256
+    # Notifications that are only ever logged, clangd sends them for every
+    # file it parses
+    IGNORED_NOTIFICATIONS = (
+        b'"textDocument/publishDiagnostics"',
+        b'"textDocument/clangd.fileStatus"',
+    )
+    # Bytes at the start of a message searched for its method
+    LSP_METHOD_PEEK_SIZE = 128
+    # Size at which clangd's stderr log is rotated, keeping one older file
+    CLANGD_STDERR_MAX_BYTES = 4 << 20
+
+    # clangd's background index, kept across runs and commits so that only
+    # the files changed since the last review get reindexed
+    CLANGD_CACHE_PATH = SANDBOX_PATH / "clangd-cache"
+    # Sandbox file name -> digest of what was last written to it
+    _sandbox_file_digests: Dict[str, bytes] = {}
+    # Definitions resolved by clangd, kept across runs
+    DEFINITION_CACHE_PATH = SANDBOX_PATH / "definitions.db"
 
     PROMPT_TEMPLATE = """
 # User Prompt
@@ -90,12 +195,10 @@ Review the following patch diff and provide inline feedback on the code changes.
     @staticmethod
     def get_kernel_coding_style() -> str:
         """Load kernel coding style guidelines from documentation."""
-        coding_style_path = os.path.join(
-            KERNEL_PATH, "Documentation/process/coding-style.rst"
-        )
         try:
-            with open(coding_style_path, "r") as f:
-                return f.read()
+            return _load_kernel_coding_style(
+                os.path.join(KERNEL_PATH, "Documentation/process/coding-style.rst")
+            )
         except Exception as e:
             return f"[Could not load kernel coding style guidelines: {e}]"
 
@@ -172,15 +275,48 @@ regulator-name.
 
 """ + cls.get_kernel_coding_style()
 
+    def _rel_path(self, path: str) -> str:
+        """Path relative to the kernel tree, computed once per path."""
+        rel_path = self._rel_paths.get(path)
+        if rel_path is None:
+            rel_path = os.path.relpath(path, self.kernel_path)
+            self._rel_paths[path] = rel_path
+        return rel_path
+
+    def _exists(self, path: str) -> bool:
+        """os.path.exists, stat'ing each path once since the review never creates sources."""
+        exists = self._exists_cache.get(path)
+        if exists is None:
+            exists = os.path.exists(path)
+            self._exists_cache[path] = exists
+        return exists
+
     def _read_file_safely(self, file_path: str) -> Optional[str]:
-        """Safely read a file and return its contents, or None on error."""
+        """
+        Safely read a file and return its contents, or None on error. The
+        MAX_CACHED_FILES most recently read files are served from memory
+        until their mtime or size changes.
+        """
         try:
+            st = os.stat(file_path)
+            with self._file_cache_lock:
+                cached = self._file_cache.get(file_path)
+                if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+                    self._file_cache.move_to_end(file_path)
+                    return cached[2]
             with open(file_path, "r") as f:
-                return f.read()
+                content = f.read()
         except Exception as e:
             self.logger.error(f"Failed to read {file_path}: {e}")
             return None
 
+        with self._file_cache_lock:
+            self._file_cache[file_path] = (st.st_mtime_ns, st.st_size, content)
+            self._file_cache.move_to_end(file_path)
+            if len(self._file_cache) > self.MAX_CACHED_FILES:
+                self._file_cache.popitem(last=False)
+        return content
+
     def _get_file_lines(self, file_path: str) -> List[str]:
         """Get file lines as a list, or empty list on error."""
         content = self._read_file_safely(file_path)
@@ -191,58 +327,100 @@ regulator-name.
         args: List[str],
         capture_output: bool = True,
         stdout_file: Optional[str] = None,
-    ) -> None:
-        """Run a make command with consistent arguments."""
+    ) -> bool:
+        """Run a make command with consistent arguments, returning whether it succeeded."""
         base_args = [
             "make",
             f"O={self.build_dir}",
-            f"-j{os.cpu_count()}",
-            "ARCH=arm64",
-            "LLVM=1",
+            f"-j{NPROC}",
+            *self.MAKE_VARIABLES,
         ]
         full_args = base_args + args
 
         desc = " ".join(args)
 
-        if capture_output:
-            self.run_cmd_with_timer(full_args, desc, cwd=str(KERNEL_PATH))
-        elif stdout_file:
-            output = self.run_cmd_with_timer(
+        if not capture_output and stdout_file:
+            # make writes the log itself rather than through our pipes
+            with open(stdout_file, "wb") as f:
+                self.run_cmd_with_timer(
+                    full_args,
+                    desc,
+                    cwd=str(self.kernel_path),
+                    stdout=f,
+                    stderr=subprocess.STDOUT,
+                )
+        else:
+            # Nothing reads stdout, only errors are worth logging
+            self.run_cmd_with_timer(
                 full_args,
                 desc,
-                cwd=str(KERNEL_PATH),
+                cwd=str(self.kernel_path),
+                stdout=subprocess.DEVNULL,
             )
-            with open(stdout_file, "w") as f:
-                f.write(output)
-        else:
-            self.run_cmd_with_timer(full_args, desc, cwd=str(KERNEL_PATH))
+        if self.returncode != 0:
+            self.logger.warning(
+                f"make {desc} failed with exit status {self.returncode}"
+            )
+            return False
+        return True
+
+    def _compile_commands_key(self) -> str:
+        """
+        Identifies what compile_commands.json is generated from: the patched
+        source tree, where it is checked out and how it is configured.
+        """
+        return "\n".join(
+            [
+                self.rebase_commit.tree.hexsha,
+                str(self.kernel_path),
+                *self.MAKE_VARIABLES,
+            ]
+        )
 
     def generate_compile_commands(self) -> None:
         """Generate compile_commands.json for clangd."""
+        compile_commands_path = self.build_dir / "compile_commands.json"
+        key_path = self.build_dir / "compile_commands.key"
+        key = self._compile_commands_key()
+        try:
+            if compile_commands_path.exists() and key_path.read_text() == key:
+                self.logger.debug("compile_commands.json is up to date")
+                return
+        except FileNotFoundError:
+            pass
+        key_path.unlink(missing_ok=True)
+
         self.logger.debug("Running make defconfig")
-        self._run_make_command(["defconfig"])
+        configured = self._run_make_command(["defconfig"])
 
         self.logger.debug("Running make")
         build_log_path = self.build_dir / "build.log"
-        self._run_make_command(
+        built = self._run_make_command(
             ["V=1"], capture_output=False, stdout_file=str(build_log_path)
         )
 
         self.logger.debug("Generating compile commands")
-        subprocess.run(
+        result = subprocess.run(
             [
                 "python3",
                 os.path.join(
-                    KERNEL_PATH, "scripts", "clang-tools", "gen_compile_commands.py"
+                    self.kernel_path,
+                    "scripts",
+                    "clang-tools",
+                    "gen_compile_commands.py",
                 ),
                 "-d",
                 str(self.build_dir),
                 "-o",
-                str(self.build_dir / "compile_commands.json"),
+                str(compile_commands_path),
             ],
             cwd=str(self.build_dir),
         )
         self.logger.debug("compile_commands.json generated")
+        # The key is only recorded for a complete compile_commands.json, which
+        # a failed or partial build does not produce
+        if configured and built and result.returncode == 0:
+            key_path.write_text(key)
 
     def _create_lsp_message(
         self, method: str, params: Dict[str, Any], msg_id: Optional[int] = None
@@ -255,44 +433,42 @@ regulator-name.
 
     def _make_message_bytes(self, msg: Dict[str, Any]) -> bytes:
         """Convert LSP message to bytes with proper headers."""
-        msg_bytes = json.dumps(msg).encode("utf-8")
-        return f"Content-Length: {len(msg_bytes)}\r\n\r\n".encode("utf-8") + msg_bytes
+        msg_bytes = _json_dumps(msg)
+        return b"Content-Length: %d\r\n\r\n%b" % (len(msg_bytes), msg_bytes)
 
     def send_workDoneProgress_response(self, proc):
         message = {"id": 0, "jsonrpc": "2.0", "result": None}
         self._send_lsp_message(proc, message)
 
     def _read_lsp_response(
-        self, proc: subprocess.Popen[Any], expected_id: Optional[int] = None
+        self,
+        proc: subprocess.Popen[Any],
+        expected_id: Optional[int] = None,
+        expected_ids: Optional[Set[int]] = None,
     ) -> Dict[str, Any]:
-        """Read and parse LSP response from process."""
+        """
+        Read and parse LSP response from process. If expected_ids is given,
+        return the first response to any of those requests.
+        """
 
-        if proc.stdout is None:
-            raise RuntimeError("Process stdout is None")
+        # Only pay for dumping the notifications when they are logged
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        # Notifications that are dropped anyway need not be parsed at all
+        skip_ignored = not debug and (
+            expected_id is not None or expected_ids is not None
+        )
 
         while True:
-            # Read headers
-            headers = b""
-            while b"\r\n\r\n" not in headers:
-                chunk = proc.stdout.read(1)
-                if chunk is None:
-                    raise RuntimeError("Failed to read from process stdout (header)")
-                headers += chunk
-
-            # Parse content length
-            content_length = 0
-            for line in headers.split(b"\r\n"):
-                if line.lower().startswith(b"content-length:"):
-                    content_length = int(line.split(b":")[1].strip())
-
-            # Read content
-            content = proc.stdout.read(content_length)
-            if content is None:
-                raise RuntimeError("Failed to read content from process stdout")
-
-            msg = json.loads(content.decode("utf-8"))
-
-            if expected_id is None or msg.get("id") == expected_id:
+            body = self._read_lsp_body(proc)
+            if skip_ignored and self._is_ignored_notification(body):
+                continue
+            msg = _json_loads(body)
+
+            if expected_ids is not None:
+                # Server-to-client requests carry their own ids and a method
+                if msg.get("id") in expected_ids and "method" not in msg:
+                    return msg
+            elif expected_id is None or msg.get("id") == expected_id:
                 return msg
 
             # Log and handle progress notifications and workDoneProgress
@@ -303,13 +479,15 @@ regulator-name.
                 continue  # Don't return, keep waiting for expected response
 
             if msg.get("method") == "textDocument/publishDiagnostics":
-                self.logger.debug(f"Received diagnostics: {json.dumps(msg, indent=2)}")
+                if debug:
+                    self.logger.debug(f"Received diagnostics: {json.dumps(msg)}")
                 continue
 
             if msg.get("method") == "textDocument/clangd.fileStatus":
-                self.logger.debug(
-                    f"Received clangd fileStatus notification: {json.dumps(msg)}"
-                )
+                if debug:
+                    self.logger.debug(
+                        f"Received clangd fileStatus notification: {json.dumps(msg)}"
+                    )
                 continue
 
             if msg.get("method") == "$/progress" and "params" in msg:
@@ -318,21 +496,88 @@ regulator-name.
                 # value = params.get("value", {})
                 if token == "backgroundIndexProgress":
                     continue
-                    self.logger.debug(f"Background index progress: {json.dumps(msg)}")
 
-            self.logger.debug(
-                f"Received LSP message with id {msg.get('id')}, expected {expected_id}: {json.dumps(msg, indent=2)}"
+            if debug:
+                self.logger.debug(
+                    f"Received LSP message with id {msg.get('id')}, expected {expected_id if expected_ids is None else expected_ids}: {json.dumps(msg)}"
+                )
+
+    def _is_ignored_notification(self, body: bytes) -> bool:
+        """
+        Whether an undecoded message is one of IGNORED_NOTIFICATIONS. clangd
+        sorts the keys of its messages, so the method is near the start.
+        """
+        head = body[: self.LSP_METHOD_PEEK_SIZE]
+        return b'"method"' in head and any(
+            method in head for method in self.IGNORED_NOTIFICATIONS
+        )
+
+    def _read_lsp_message(self, proc: subprocess.Popen[Any]) -> Dict[str, Any]:
+        """Read and decode the next LSP message from the process."""
+        return _json_loads(self._read_lsp_body(proc))
+
+    def _read_lsp_body(self, proc: subprocess.Popen[Any]) -> bytes:
+        """
+        Read the body of the next LSP message from the process. Data is read
+        from stdout in large chunks into a per-process buffer that messages
+        are framed from.
+        """
+        buf = self._rx_bufs.setdefault(proc, bytearray())
+        while True:
+            header_end = buf.find(b"\r\n\r\n")
+            if header_end != -1:
+                content_length = 0
+                for line in bytes(buf[:header_end]).split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        content_length = int(line.split(b":", 1)[1].strip())
+                content_start = header_end + 4
+                content_end = content_start + content_length
+                if len(buf) >= content_end:
+                    content = bytes(buf[content_start:content_end])
+                    del buf[:content_end]
+                    return content
+            self._fill_lsp_buffer(proc, buf)
+
+    def _fill_lsp_buffer(self, proc: subprocess.Popen[Any], buf: bytearray) -> None:
+        """Append whatever the process has written to stdout, waiting if there is none."""
+        if proc.stdout is None:
+            raise RuntimeError("Process stdout is None")
+        fd = proc.stdout.fileno()
+        if not select.select([fd], [], [], self.LSP_READ_TIMEOUT)[0]:
+            raise TimeoutError(
+                f"clangd sent nothing for {self.LSP_READ_TIMEOUT} seconds"
             )
+        chunk = os.read(fd, self.LSP_READ_SIZE)
+        if not chunk:
+            raise RuntimeError("Failed to read from process stdout")
+        buf += chunk
 
     def _send_lsp_message(
-        self, proc: subprocess.Popen[Any], message: Dict[str, Any]
+        self, proc: subprocess.Popen[Any], message: Dict[str, Any], flush: bool = True
     ) -> None:
-        """Send an LSP message to the process."""
+        """Send an LSP message to the process, flushing it unless more follow."""
         if proc.stdin is None:
             raise RuntimeError("Process stdin is None")
         proc.stdin.write(self._make_message_bytes(message))
+        if flush:
+            proc.stdin.flush()
+
+    def _drain_until(
+        self, proc: subprocess.Popen[Any], ids: Set[int]
+    ) -> Dict[int, Dict[str, Any]]:
+        """Flush queued requests and read responses until all of ids have arrived."""
+        if proc.stdin is None:
+            raise RuntimeError("Process stdin is None")
         proc.stdin.flush()
 
+        responses: Dict[int, Dict[str, Any]] = {}
+        pending = set(ids)
+        while pending:
+            msg = self._read_lsp_response(proc, expected_ids=pending)
+            pending.discard(msg["id"])
+            responses[msg["id"]] = msg
+        return responses
+
     def _initialize_lsp(
         self, proc: subprocess.Popen[Any], project_root: os.PathLike[str]
     ) -> None:
@@ -373,8 +618,16 @@ regulator-name.
         uri: str,
         text: Optional[str] = None,
         language: str = "c",
+        flush: bool = True,
     ) -> None:
-        """Open a file in the LSP server. If text is not provided, omit it from the message."""
+        """
+        Open a file in the LSP server. If text is not provided, omit it from the message.
+        Files that are already open are skipped.
+        """
+        opened_uris = self._opened_uris.setdefault(proc, set())
+        if uri in opened_uris:
+            return
+        opened_uris.add(uri)
         self.logger.debug(f"Opening file in LSP: {uri}")
         text_document = {"uri": uri, "languageId": language, "version": 1}
         if text is not None:
@@ -382,116 +635,125 @@ regulator-name.
         didopen_msg = self._create_lsp_message(
             "textDocument/didOpen", {"textDocument": text_document}
         )
-        self._send_lsp_message(proc, didopen_msg)
-        time.sleep(0.1)  # Allow LSP to process
+        # No need to wait for clangd to parse the file, it handles later
+        # requests for the document in order once the parse is done
+        self._send_lsp_message(proc, didopen_msg, flush=flush)
+
+    def _open_files_in_lsp(
+        self, proc: subprocess.Popen[Any], filenames: List[str]
+    ) -> None:
+        """
+        Open all of the given kernel files at once, so that clangd parses them
+        concurrently instead of one at a time as they are processed.
+        """
+        for filename in filenames:
+            abs_path = os.path.join(self.kernel_path, filename)
+            if not self._exists(abs_path):
+                continue
+            text = self._read_file_safely(abs_path)
+            if text:
+                self._open_file_in_lsp(proc, path_to_uri(abs_path), text, flush=False)
+        if proc.stdin is None:
+            raise RuntimeError("Process stdin is None")
+        proc.stdin.flush()
 
     def _find_definition(
         self, proc: subprocess.Popen[Any], uri: str, line: int, character: int
-    ) -> Dict[str, Any]:
-        """Find definition using LSP."""
+    ) -> int:
+        """Queue a definition request without waiting for it and return its ID."""
+        msg_id = next(self._msg_ids)
         def_msg = self._create_lsp_message(
             "textDocument/definition",
             {
                 "textDocument": {"uri": uri},
                 "position": {"line": line, "character": character},
             },
-            self.DEFINITION_MSG_ID,
-        )
-
-        self._send_lsp_message(proc, def_msg)
-        return self._read_lsp_response(proc, expected_id=self.DEFINITION_MSG_ID)
-
-    def _find_actual_definition(
-        self,
-        proc: subprocess.Popen[Any],
-        uri: str,
-        line: int,
-        character: int,
-        identifier: str,
-    ) -> Dict[str, Any]:
-        # Log the original identifier location
-        self.logger.debug(
-            f"Looking up definition for identifier '{identifier}' at location: {uri}:{line}:{character}"
-        )
-        current_location = LSPLocation(uri, line, character)
-
-        # # Always perform two definition lookups and only use the second result (first is assumed cache miss)
-        # resp_first = self._find_definition(proc, current_location.uri, current_location.line, current_location.character)
-        # self.logger.debug(f"Clangd response for definition request (assumed cache miss): {json.dumps(resp_first, indent=2)}")
-
-        # # If the first response has a result, open the file containing the supposed definition in the LSP
-        # def_file_uri = None
-        # def_file_text = None
-        # if resp_first.get("result") and len(resp_first["result"]) > 0:
-        #     loc = resp_first["result"][0]
-        #     def_file_uri = loc["uri"]
-        #     def_file_path = def_file_uri.replace("file://", "")
-        #     if os.path.exists(def_file_path):
-        #         def_file_text = self._read_file_safely(def_file_path)
-        #         self._open_file_in_lsp(proc, def_file_uri, def_file_text)
-        #         self.wait_for_diagnostics(proc, def_file_uri, timeout=15)
-        # else:
-        #     self.logger.warning(f"No definition found for {identifier} at {current_location.uri}:{current_location.line}:{current_location.character}.")
-
-        # Wait for clangd indexing for 1 second before retrying
-        # # self.wait_for_clangd_indexing(proc, max_total_wait=15) # TEMP reset to max_total_wait=1
-        resp_second = self._find_definition(
-            proc,
-            current_location.uri,
-            current_location.line,
-            current_location.character,
-        )
-        self.logger.debug(
-            f"Clangd response for definition request (used result): {json.dumps(resp_second, indent=2)}"
+            msg_id,
         )
-
-        if resp_second.get("result") and len(resp_second["result"]) > 0:
-            loc = resp_second["result"][0]
-            new_location = LSPLocation(
-                loc["uri"],
-                loc["range"]["start"]["line"],
-                loc["range"]["start"]["character"],
-            )
-            self.logger.debug(
-                f"Found at {new_location.uri}:{new_location.line}:{new_location.character} (after forced retry)"
-            )
-        else:
-            self.logger.debug(
-                f"No definition found for {identifier} after forced retry."
-            )
-        return resp_second
-
-    def _get_document_symbols(
-        self, proc: subprocess.Popen[Any], uri: str, text: str, identifier: str
-    ) -> Optional[Dict[str, Any]]:
-        """Get document symbols and find specific identifier."""
-        self._open_file_in_lsp(proc, uri, text, language="c")
-
+        self._send_lsp_message(proc, def_msg, flush=False)
+        return msg_id
+
+    def _request_document_symbols(
+        self, proc: subprocess.Popen[Any], uri: str, flush: bool = False
+    ) -> int:
+        """Send a document symbol request without waiting for it and return its ID."""
+        msg_id = next(self._msg_ids)
         doc_symbol_msg = self._create_lsp_message(
             "textDocument/documentSymbol",
             {"textDocument": {"uri": uri}},
-            self.SYMBOL_MSG_ID,
+            msg_id,
         )
+        self._send_lsp_message(proc, doc_symbol_msg, flush=flush)
+        return msg_id
 
-        self._send_lsp_message(proc, doc_symbol_msg)
-        symbol_resp = self._read_lsp_response(proc, expected_id=self.SYMBOL_MSG_ID)
-
-        if symbol_resp.get("result"):
-            for sym in symbol_resp["result"]:
-                if sym.get("name") == identifier:
-                    return sym
-        return None
+    def _find_definitions(
+        self,
+        proc: subprocess.Popen[Any],
+        uri: str,
+        positions: List[Tuple[int, int]],
+    ) -> List[Dict[str, Any]]:
+        """Find the definitions at all positions of uri using pipelined LSP requests."""
+        responses: List[Dict[str, Any]] = []
+        for i in range(0, len(positions), self.MAX_PIPELINED_REQUESTS):
+            msg_ids = [
+                self._find_definition(proc, uri, line, character)
+                for line, character in positions[i : i + self.MAX_PIPELINED_REQUESTS]
+            ]
+            by_id = self._drain_until(proc, set(msg_ids))
+            responses.extend(by_id[msg_id] for msg_id in msg_ids)
+        return responses
+
+    def _get_documents_symbols(
+        self, proc: subprocess.Popen[Any], uris: List[str]
+    ) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        Open each file and fetch its document symbols by name using pipelined
+        LSP requests. Symbols are cached until the file is modified.
+        """
+        symbols: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        missing: List[Tuple[str, int]] = []
+        for uri in uris:
+            try:
+                mtime = os.stat(uri_to_path(uri)).st_mtime_ns
+            except OSError:
+                continue
+            cached = self._doc_symbol_cache.get(uri)
+            if cached is not None and cached[0] == mtime:
+                symbols[uri] = cached[1]
+            else:
+                missing.append((uri, mtime))
 
-    def parse_diff(self, diff_lines: List[str]) -> Dict[str, Set[int]]:
-        """Parse diff lines to extract file additions and their line numbers."""
-        file_adds: Dict[str, Set[int]] = {}
+        for i in range(0, len(missing), self.MAX_PIPELINED_REQUESTS):
+            msg_ids: Dict[int, Tuple[str, int]] = {}
+            for uri, mtime in missing[i : i + self.MAX_PIPELINED_REQUESTS]:
+                text = self._read_file_safely(uri_to_path(uri))
+                if not text:
+                    continue
+                self._open_file_in_lsp(proc, uri, text, language="c", flush=False)
+                msg_ids[self._request_document_symbols(proc, uri)] = (uri, mtime)
+            for msg_id, resp in self._drain_until(proc, set(msg_ids)).items():
+                uri, mtime = msg_ids[msg_id]
+                # The first symbol of each name wins
+                by_name: Dict[str, Dict[str, Any]] = {}
+                for sym in resp.get("result") or []:
+                    by_name.setdefault(sym.get("name"), sym)
+                self._doc_symbol_cache[uri] = (mtime, by_name)
+                symbols[uri] = by_name
+        return symbols
+
+    def parse_diff(self, diff_lines: Iterable[str]) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Parse diff lines to extract file additions as sorted, inclusive
+        (start, end) ranges of their line numbers.
+        """
+        file_adds: Dict[str, List[Tuple[int, int]]] = {}
         current_file: Optional[str] = None
         new_line: Optional[int] = None
 
         for line in diff_lines:
             if line.startswith("+++ b/"):
                 current_file = line[6:].strip()
-                file_adds[current_file] = set()
+                file_adds[current_file] = []
             elif line.startswith("@@"):
                 match = re.match(r"@@ -\d+(,\d+)? \+(\d+)(,\d+)? @@", line)
                 if match:
@@ -502,7 +764,12 @@ regulator-name.
                 and current_file is not None
                 and new_line is not None
             ):
-                file_adds[current_file].add(new_line)
+                adds = file_adds[current_file]
+                # Extend the current run of added lines or start a new one
+                if adds and adds[-1][1] == new_line - 1:
+                    adds[-1] = (adds[-1][0], new_line)
+                else:
+                    adds.append((new_line, new_line))
                 new_line += 1
             elif (
                 not line.startswith("-")
@@ -518,36 +785,46 @@ regulator-name.
         self, line: str, line_number: int
     ) -> List[Tuple[str, int, int]]:
         """Extract all identifiers from a line with their positions."""
-        results: List[Tuple[str, int, int]] = []
-        for match in re.finditer(self.IDENTIFIER_PATTERN, line):
-            identifier = match.group(0)
-            char_offset = match.start()
-            results.append((identifier, line_number, char_offset))
-        return results
-
-    def _find_symbol_and_parent(
-        self, symbols: List[Dict[str, Any]], identifier: str, line: int
-    ) -> Optional[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
-        """Recursively search the symbol tree for the symbol matching identifier at the given line."""
-
-        def helper(
-            nodes: List[Dict[str, Any]], parent: Optional[Dict[str, Any]] = None
-        ) -> Optional[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
-            for node in nodes:
-                rng = node.get("range")
-                if (
-                    node.get("name") == identifier
-                    and rng
-                    and rng["start"]["line"] <= line <= rng["end"]["line"]
-                ):
-                    return (node, parent)
-                if "children" in node:
-                    found = helper(node["children"], node)
-                    if found:
-                        return found
-            return None
+        return [
+            (match.group(0), line_number, match.start())
+            for match in self._IDENT_RE.finditer(line)
+        ]
+
+    def _build_symbol_index(
+        self, symbols: List[Dict[str, Any]]
+    ) -> Dict[str, List[Tuple[int, int, Optional[Tuple[int, int]]]]]:
+        """
+        Index a document symbol tree by name. Each name maps to the
+        (start, end, parent range) of its symbols in depth-first order.
+        """
+        index: Dict[str, List[Tuple[int, int, Optional[Tuple[int, int]]]]] = {}
+        stack: List[Tuple[Dict[str, Any], Optional[Tuple[int, int]]]] = [
+            (node, None) for node in reversed(symbols)
+        ]
+        while stack:
+            node, parent_range = stack.pop()
+            rng = node.get("range")
+            if rng:
+                index.setdefault(node.get("name"), []).append(
+                    (rng["start"]["line"], rng["end"]["line"], parent_range)
+                )
+            children = node.get("children")
+            if children:
+                node_range = (rng["start"]["line"], rng["end"]["line"]) if rng else None
+                stack.extend((child, node_range) for child in reversed(children))
+        return index
 
-        return helper(symbols)
+    def _find_parent_range(
+        self,
+        symbol_index: Dict[str, List[Tuple[int, int, Optional[Tuple[int, int]]]]],
+        identifier: str,
+        line: int,
+    ) -> Optional[Tuple[int, int]]:
+        """Range of the parent of the first symbol named identifier that spans line."""
+        for start, end, parent_range in symbol_index.get(identifier, ()):
+            if start <= line <= end:
+                return parent_range
+        return None
 
     def _collect_definition(
         self,
@@ -569,99 +846,92 @@ regulator-name.
         else:
             collected_defs[def_file].append((start, end, identifier))
 
-    def _build_essential_lines(
+    def _build_essential_ranges(
         self,
         collected_defs: Dict[str, List[Tuple[int, int, str]]],
-        diff_line_numbers: Dict[str, Set[int]],
+        diff_ranges: Dict[str, List[Tuple[int, int]]],
         def_file: str,
-    ) -> Set[int]:
-        """Build set of essential lines to print: diff lines + all definition regions."""
-        essential_lines: Set[int] = set()
-
-        # Add diff lines
-        diff_lines = diff_line_numbers.get(
-            os.path.relpath(def_file, KERNEL_PATH), set()
+    ) -> List[Tuple[int, int]]:
+        """Build the line ranges to print: diff lines + all definition regions."""
+        essential_ranges = list(diff_ranges.get(self._rel_path(def_file), []))
+        essential_ranges.extend(
+            (start, end) for start, end, _ in collected_defs.get(def_file, [])
         )
-        essential_lines.update(diff_lines)
-
-        # Add definition ranges
-        for start, end, _ in collected_defs.get(def_file, []):
-            essential_lines.update(range(start, end + 1))
-
-        return essential_lines
-
-    def _fill_context_gaps(self, essential_lines: Set[int]) -> Set[int]:
-        """Fill gaps of MAX_GAP or less between essential lines."""
-        if not essential_lines:
-            return essential_lines
-
-        sorted_lines = sorted(essential_lines)
-        print_lines = set(essential_lines)
-
-        for i in range(len(sorted_lines) - 1):
-            current_line = sorted_lines[i]
-            next_line = sorted_lines[i + 1]
-            gap_size = next_line - current_line - 1
-
-            # Fill gaps of MAX_GAP or less
-            if 0 < gap_size <= self.MAX_GAP:
-                print_lines.update(range(current_line + 1, next_line))
+        return essential_ranges
+
+    def _merge_ranges(self, ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Merge overlapping ranges and those separated by a gap of MAX_GAP or less."""
+        merged: List[Tuple[int, int]] = []
+        for start, end in sorted(ranges):
+            if merged and start - merged[-1][1] - 1 <= self.MAX_GAP:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
 
-        return print_lines
+    def _format_file_context(
+        self, def_file: str, print_ranges: List[Tuple[int, int]]
+    ) -> List[str]:
+        """
+        Format file context with proper gap indicators. The file is streamed
+        so only the printed lines are kept in memory.
+        """
+        file_context: List[str] = []
+        # Lines read so far, and the end of the last printed region
+        pos = 0
+        printed_end = 0
 
-    def _format_file_context(self, def_file: str, print_lines: Set[int]) -> List[str]:
-        """Format file context with proper gap indicators."""
-        lines = self._get_file_lines(def_file)
-        if not lines:
+        try:
+            with open(def_file, "r") as f:
+                for start, end in print_ranges:
+                    pos += sum(1 for _ in itertools.islice(f, start - pos))
+                    if pos < start:
+                        break
+                    self._append_gap_marker(file_context, printed_end, start)
+                    region = list(itertools.islice(f, end - start + 1))
+                    file_context.extend(region)
+                    pos += len(region)
+                    printed_end = pos
+                n_lines = pos + sum(1 for _ in f)
+        except Exception as e:
+            self.logger.error(f"Failed to read {def_file}: {e}")
             return []
 
-        file_context: List[str] = []
-        n_lines = len(lines)
-        i = 0
-
-        while i < n_lines:
-            if i in print_lines:
-                # Start of a region to print
-                region_start = i
-                while i < n_lines and i in print_lines:
-                    i += 1
-                region_end = i
-                file_context.extend(lines[region_start:region_end])
-            else:
-                # Start of a gap
-                gap_start = i
-                while i < n_lines and i not in print_lines:
-                    i += 1
-                gap_len = i - gap_start
-
-                if gap_len > self.MAX_GAP:
-                    # Convert 0-based to 1-based line numbers for display
-                    start_line = gap_start + 1
-                    end_line = gap_start + gap_len
-                    file_context.append(f"// skipping lines {start_line}-{end_line}\n")
+        if not n_lines:
+            return []
+        self._append_gap_marker(file_context, printed_end, n_lines)
 
         return file_context
 
+    def _append_gap_marker(
+        self, file_context: List[str], gap_start: int, gap_end: int
+    ) -> None:
+        """Note skipped lines [gap_start, gap_end) unless the gap is MAX_GAP or less."""
+        if gap_end - gap_start > self.MAX_GAP:
+            # Convert 0-based to 1-based line numbers for display
+            file_context.append(f"// skipping lines {gap_start + 1}-{gap_end}\n")
+
     def _get_definition_context(
         self,
         collected_defs: Dict[str, List[Tuple[int, int, str]]],
-        diff_line_numbers: Dict[str, Set[int]],
+        diff_ranges: Dict[str, List[Tuple[int, int]]],
     ) -> List[str]:
         """Build context strings for all found definitions."""
         context_parts: List[str] = []
 
         for def_file in collected_defs:
-            essential_lines = self._build_essential_lines(
-                collected_defs, diff_line_numbers, def_file
+            essential_ranges = self._build_essential_ranges(
+                collected_defs, diff_ranges, def_file
             )
-            if not essential_lines:
+            if not essential_ranges:
                 continue
 
-            print_lines = self._fill_context_gaps(essential_lines)
-            file_context = self._format_file_context(def_file, print_lines)
+            print_ranges = self._merge_ranges(essential_ranges)
+            file_context = self._format_file_context(def_file, print_ranges)
 
             if file_context:
-                rel_path = os.path.relpath(def_file, KERNEL_PATH).lstrip("/\\")
+                rel_path = self._rel_path(def_file).lstrip("/\\")
                 context_parts.append(
                     f"{rel_path} (definition/diff context):\n\n```c\n"
                     + "".join(file_context)
@@ -673,22 +943,23 @@ regulator-name.
     def _merge_and_build_context(
         self,
         collected_defs: Dict[str, List[Tuple[int, int, str]]],
-        file_adds: Dict[str, Set[int]],
+        file_adds: Dict[str, List[Tuple[int, int]]],
     ) -> str:
         """Build the final context string from collected definitions."""
-        diff_line_numbers = {file: set(lines) for file, lines in file_adds.items()}
-        context_parts = self._get_definition_context(collected_defs, diff_line_numbers)
+        context_parts = self._get_definition_context(collected_defs, file_adds)
         return "\n\n".join(context_parts)
 
-    def _setup_lsp_client(self) -> subprocess.Popen[Any]:
+    def _setup_lsp_client(self, worker: int = 0) -> subprocess.Popen[Any]:
         """Set up and initialize the LSP client, and start background notification logger."""
         proc = subprocess.Popen(
             [
                 "clangd",
                 "--header-insertion=never",
-                "--pretty",
                 f"--compile-commands-dir={self.build_dir}",
                 "--background-index",
+                # The extra workers index the same compile database, so they
+                # yield the CPU to the first one
+                f"--background-index-priority={'normal' if worker == 0 else 'low'}",
                 "--print-all-options",
                 # "--log=verbose",
                 "--log=error",
@@ -697,21 +968,37 @@ regulator-name.
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            cwd=str(KERNEL_PATH),
+            cwd=str(self.kernel_path),
         )
 
         def _stderr_reader(stderr, logger):
-            log_path = os.path.join(SANDBOX_PATH, "clangd_stderr.log")
+            log_name = (
+                "clangd_stderr.log" if worker == 0 else f"clangd_stderr_{worker}.log"
+            )
+            log_path = os.path.join(SANDBOX_PATH, log_name)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
             try:
-                with open(log_path, "w") as log_file:
-                    while True:
-                        line = stderr.readline(4096)
-                        if not line:
-                            break
-                        decoded_line = line.decode(errors="replace").rstrip()
-                        # Print to console for explicit visibility
-                        logger.debug(f"clangd stderr: {decoded_line}")
-                        log_file.write(decoded_line + "\n")
+                log_file = open(log_path, "w")
+                log_size = 0
+                try:
+                    # Read whatever is available in blocks rather than line by line
+                    while chunk := os.read(stderr.fileno(), 64 * 1024):
+                        text = decoder.decode(chunk)
+                        if logger.isEnabledFor(logging.DEBUG):
+                            for decoded_line in text.splitlines():
+                                # Print to console for explicit visibility
+                                logger.debug(f"clangd stderr: {decoded_line}")
+
+                        # Bound the log on long indexing runs
+                        if log_size + len(chunk) > self.CLANGD_STDERR_MAX_BYTES:
+                            log_file.close()
+                            os.replace(log_path, log_path + ".1")
+                            log_file = open(log_path, "w")
+                            log_size = 0
+                        log_file.write(text)
+                        log_size += len(chunk)
+                finally:
+                    log_file.close()
             except Exception as e:
                 logger.error(f"Error reading clangd stderr: {e}")
 
@@ -723,74 +1010,88 @@ regulator-name.
         # stdout_logger_thread = threading.Thread(target=_stdout_notification_logger, args=(proc.stdout, self.logger), daemon=True)
         # stdout_logger_thread.start()
 
-        self._initialize_lsp(proc, KERNEL_PATH)
+        self._initialize_lsp(proc, self.kernel_path)
         return proc
 
     def _process_file_identifiers(
         self,
         proc: subprocess.Popen[Any],
         filename: str,
-        lines: Set[int],
+        add_ranges: List[Tuple[int, int]],
         collected_defs: Dict[str, List[Tuple[int, int, str]]],
         printed_defs: Set[str],
         printed_locations: Set[Tuple[str, int, int]],
     ) -> None:
         """Process identifiers in a specific file."""
-        abs_path = os.path.join(KERNEL_PATH, filename)
-        uri = f"file://{abs_path}"
+        abs_path = os.path.join(self.kernel_path, filename)
+        uri = path_to_uri(abs_path)
 
-        if not os.path.exists(abs_path):
+        if not self._exists(abs_path):
             return
 
         file_lines = self._get_file_lines(abs_path)
         if not file_lines:
             return
 
-        self._open_file_in_lsp(proc, uri, "".join(file_lines))
+        # Ask for the document symbols up front so that clangd parses the file
+        # while the identifiers are extracted
+        self._open_file_in_lsp(proc, uri, "".join(file_lines), flush=False)
+        doc_symbol_id = self._request_document_symbols(proc, uri, flush=True)
 
         # Extract identifiers from added lines
         idents_with_pos: List[Tuple[str, int, int]] = []
-        for lnum in lines:
-            if lnum < len(file_lines):
+        for start, end in add_ranges:
+            for lnum in range(start, min(end + 1, len(file_lines))):
                 idents_with_pos.extend(
                     self.extract_identifiers_with_positions(file_lines[lnum], lnum)
                 )
 
-        # Get document symbols for the file
-        doc_symbol_msg = self._create_lsp_message(
-            "textDocument/documentSymbol",
-            {"textDocument": {"uri": uri}},
-            self.DOC_SYMBOL_MSG_ID,
-        )
-
-        self._send_lsp_message(proc, doc_symbol_msg)
-        symbol_resp = self._read_lsp_response(proc, expected_id=self.DOC_SYMBOL_MSG_ID)
+        symbol_resp = self._drain_until(proc, {doc_symbol_id})[doc_symbol_id]
         symbols = symbol_resp.get("result", [])
 
+        # Identifiers collected from a previous file are skipped anyway, and
+        # each remaining one is looked up at its first occurrence only, falling
+        # back to the next ones while it cannot be resolved
+        seen_idents = set(printed_defs) | self.SKIPPED_IDENTIFIERS
+        positions_by_ident: Dict[str, List[Tuple[int, int]]] = {}
         for ident, lnum, col in idents_with_pos:
-            self.logger.debug(
-                f"Processing identifier '{ident}' at {uri}:{lnum + 1}:{col + 1}"
-            )
-
-            resp = self._find_actual_definition(proc, uri, lnum, col, ident)
-            if not resp.get("result") or len(resp["result"]) == 0:
-                continue
-            loc = resp["result"][0]
-            def_file = loc["uri"].replace("file://", "")
-            if not os.path.exists(def_file):
-                continue
-            header_contents = self._read_file_safely(def_file)
-            if not header_contents:
-                continue
-            def_symbol = self._get_document_symbols(
-                proc, loc["uri"], header_contents, ident
+            if ident not in seen_idents:
+                positions_by_ident.setdefault(ident, []).append((lnum, col))
+
+        function_ranges = self._get_function_ranges(symbols)
+        src_sha = hashlib.sha1("".join(file_lines).encode()).digest()
+        resolved: Dict[str, Tuple[int, int, Optional[Tuple[str, int, int]]]] = {}
+        pending = list(positions_by_ident)
+        for attempt in range(self.MAX_IDENTIFIER_ATTEMPTS):
+            candidates = [
+                (ident, *positions_by_ident[ident][attempt])
+                for ident in pending
+                if attempt < len(positions_by_ident[ident])
+            ]
+            if not candidates:
+                break
+            def_locs = self._resolve_identifiers(
+                proc, uri, abs_path, file_lines, function_ranges, src_sha, candidates
             )
-
-        self.logger.debug("Sleeping and trying again")
-        time.sleep(15)
+            pending = []
+            for (ident, lnum, col), def_loc in zip(candidates, def_locs):
+                # Unresolved identifiers are reported at their first occurrence
+                if def_loc is not None or ident not in resolved:
+                    resolved[ident] = (lnum, col, def_loc)
+                if def_loc is None:
+                    pending.append(ident)
+        with self._def_cache_lock:
+            self._def_cache.commit()
+
+        # In order of first occurrence
+        idents_with_pos = [
+            (ident, *resolved[ident][:2]) for ident in positions_by_ident
+        ]
+        def_locs = [resolved[ident][2] for ident in positions_by_ident]
 
         # Process each identifier
-        for ident, lnum, col in idents_with_pos:
+        symbol_index = self._build_symbol_index(symbols or [])
+        for (ident, lnum, col), def_loc in zip(idents_with_pos, def_locs):
             self.logger.debug(
                 f"Processing identifier '{ident}' at {uri}:{lnum + 1}:{col + 1}"
             )
@@ -800,50 +1101,12 @@ regulator-name.
             ):  # TODO we shouldn't be skipping all matching identifiers, we should be only skipping duplicate definitions. It's possible that 2 matching identifiers (at different positions) actually have different definitions.
                 continue
 
-            resp = self._find_actual_definition(proc, uri, lnum, col, ident)
-            if not resp.get("result") or len(resp["result"]) == 0:
-                self.logger.debug(
-                    f"No definition found for {ident} in {uri} at line {lnum + 1}, column {col + 1}."
-                )
-                continue
-
-            loc = resp["result"][0]
-            def_file = loc["uri"].replace("file://", "")
-
-            if not os.path.exists(def_file):
-                continue
-
-            header_contents = self._read_file_safely(def_file)
-            if not header_contents:
-                continue
-
-            def_symbol = self._get_document_symbols(
-                proc, loc["uri"], header_contents, ident
-            )
-
-            if def_symbol:
-                start = def_symbol["location"]["range"]["start"]["line"]
-                end = def_symbol["location"]["range"]["end"]["line"]
-            else:
-                self.logger.debug(
-                    f"Definition for {ident}, {lnum}, {col} not found in {def_file}."
-                )
-                start = loc["range"]["start"]["line"]
-                end = loc["range"]["end"]["line"]
-
-            def_loc = (def_file, start, end)
-            if def_loc in printed_locations:
+            if def_loc is None or def_loc in printed_locations:
                 continue
+            def_file, start, end = def_loc
 
             # Find parent symbol range
-            parent_range = None
-            if symbols:
-                found = self._find_symbol_and_parent(symbols, ident, start)
-                if found and found[1]:
-                    parent = found[1]
-                    prng = parent.get("range")
-                    if prng:
-                        parent_range = (prng["start"]["line"], prng["end"]["line"])
+            parent_range = self._find_parent_range(symbol_index, ident, start)
 
             self._collect_definition(
                 def_file, start, end, ident, collected_defs, parent_range
@@ -851,190 +1114,296 @@ regulator-name.
             printed_defs.add(ident)
             printed_locations.add(def_loc)
 
-    def wait_for_diagnostics(
-        self, proc: subprocess.Popen[Any], file_uri: str, timeout: int = 10
-    ) -> Optional[dict]:
+    def _resolve_identifiers(
+        self,
+        proc: subprocess.Popen[Any],
+        uri: str,
+        abs_path: str,
+        file_lines: List[str],
+        function_ranges: List[Tuple[int, int]],
+        src_sha: bytes,
+        idents_with_pos: List[Tuple[str, int, int]],
+    ) -> List[Optional[Tuple[str, int, int]]]:
+        """Find the (file, start, end) range of the definition of each identifier."""
+        # Locals and parameters are declared in the enclosing function, and
+        # definitions resolved by a previous run are taken from the cache
+        def_locs: List[Optional[Tuple[str, int, int]]] = [
+            self._find_local_declaration(
+                abs_path, file_lines, function_ranges, ident, lnum
+            )
+            or self._get_cached_definition(src_sha, ident, lnum, col)
+            for ident, lnum, col in idents_with_pos
+        ]
+        misses = [i for i, def_loc in enumerate(def_locs) if def_loc is None]
+        def_resps = self._find_definitions(
+            proc, uri, [idents_with_pos[i][1:] for i in misses]
+        )
+
+        # Fetch the symbols of every file holding a definition in one batch
+        def_uris: Dict[str, None] = {}
+        for resp in def_resps:
+            if resp.get("result"):
+                def_uri = resp["result"][0]["uri"]
+                if self._exists(uri_to_path(def_uri)):
+                    def_uris[def_uri] = None
+        def_symbols = self._get_documents_symbols(proc, list(def_uris))
+
+        for i, resp in zip(misses, def_resps):
+            ident, lnum, col = idents_with_pos[i]
+            def_locs[i] = self._resolve_definition(
+                uri, ident, lnum, col, resp, def_symbols
+            )
+            if def_locs[i] is not None:
+                self._cache_definition(src_sha, ident, lnum, col, def_locs[i])
+        return def_locs
+
+    def _get_function_ranges(
+        self, symbols: List[Dict[str, Any]]
+    ) -> List[Tuple[int, int]]:
+        """Sorted line ranges of the functions among a file's document symbols."""
+        ranges: List[Tuple[int, int]] = []
+        stack = list(symbols)
+        while stack:
+            sym = stack.pop()
+            if sym.get("kind") in self.FUNCTION_SYMBOL_KINDS:
+                rng = sym.get("range") or sym.get("location", {}).get("range")
+                if rng:
+                    ranges.append((rng["start"]["line"], rng["end"]["line"]))
+            stack.extend(sym.get("children", []))
+        ranges.sort()
+        return ranges
+
+    def _find_local_declaration(
+        self,
+        abs_path: str,
+        file_lines: List[str],
+        function_ranges: List[Tuple[int, int]],
+        ident: str,
+        lnum: int,
+    ) -> Optional[Tuple[str, int, int]]:
         """
-        Wait for textDocument/publishDiagnostics for the given file URI.
-        Returns the diagnostics params dict, or None if timeout.
+        Find the declaration of a local variable or parameter used on line
+        lnum, without asking clangd. Returns the (file, start, end) range of
+        the declaring line like a definition lookup would.
         """
+        idx = bisect.bisect_right(function_ranges, (lnum, float("inf"))) - 1
+        if idx < 0 or function_ranges[idx][1] < lnum:
+            return None
+
+        start = function_ranges[idx][0]
+        decls = self._local_declarations.get((abs_path, start))
+        if decls is None:
+            decls = self._scan_local_declarations(file_lines, function_ranges[idx])
+            self._local_declarations[(abs_path, start)] = decls
+
+        # The line using the identifier is not where it is declared
+        decl_lnum = decls.get(ident)
+        if decl_lnum is None or decl_lnum >= lnum:
+            return None
         self.logger.debug(
-            f"Waiting for diagnostics for {file_uri} with timeout {timeout} seconds"
+            f"Found local declaration of '{ident}' at {abs_path}:{decl_lnum + 1}"
         )
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            try:
-                msg = self._read_lsp_response(proc)
-            except Exception as e:
-                self.logger.debug(f"Exception while waiting for diagnostics: {e}")
-                break
-            if msg.get("method") == "textDocument/publishDiagnostics":
-                params = msg.get("params", {})
-                if params.get("uri") == file_uri:
-                    self.logger.debug(
-                        f"Received diagnostics for {file_uri}: {json.dumps(msg, indent=2)}"
-                    )
-                    return params
+        return (abs_path, decl_lnum, decl_lnum)
+
+    def _scan_local_declarations(
+        self, file_lines: List[str], function_range: Tuple[int, int]
+    ) -> Dict[str, int]:
+        """Map each identifier declared in a function to its first declaring line."""
+        decls: Dict[str, int] = {}
+        start, end = function_range
+        for decl_lnum in range(start, min(end + 1, len(file_lines))):
+            for match in _LOCAL_DECL_RE.finditer(file_lines[decl_lnum]):
+                if match.group(1) not in self.NON_DECLARING_WORDS:
+                    decls.setdefault(match.group(2), decl_lnum)
+        return decls
+
+    def _resolve_definition(
+        self,
+        uri: str,
+        ident: str,
+        lnum: int,
+        col: int,
+        resp: Dict[str, Any],
+        def_symbols: Dict[str, Dict[str, Dict[str, Any]]],
+    ) -> Optional[Tuple[str, int, int]]:
+        """Turn a definition response into the (file, start, end) range of the definition."""
+        if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug(
-                f"Received message that wasn't a diagnostic message for {file_uri}: {json.dumps(msg)}"
+                f"Clangd response for definition request: {json.dumps(resp)}"
             )
-        self.logger.warning(f"Timeout waiting for diagnostics for {file_uri}")
-        return None
+        if not resp.get("result") or len(resp["result"]) == 0:
+            self.logger.debug(
+                f"No definition found for {ident} in {uri} at line {lnum + 1}, column {col + 1}."
+            )
+            return None
 
-    def wait_for_clangd_indexing(
-        self,
-        proc: subprocess.Popen[Any],
-        max_total_wait: int = 600,
-        max_stale_time: int = 60,
-        interval: int = 1,
-        max_interval: int = 10,
-    ) -> None:
-        """
-        Wait for clangd background indexing progress notifications, using exponential backoff.
-        Reads all available messages from proc.stdout without pausing, only sleeps when no messages are available.
-        Breaks if:
-          - percentage reaches 100
-          - no $/progress notification is received for max_wait seconds
-          - the value does not change from the last message for max_wait seconds
-        """
-        import select
-
-        last_percentage = None
-        last_value = None
-        waited = 0
-        current_interval = interval
-        start_time = time.time()
-        while time.time() - start_time < max_total_wait:
-            message_read = False
-            while True:
-                # Check if there's data to read from proc.stdout
-                ready = select.select([proc.stdout], [], [], 0)[0]
-                if not ready:
-                    break
-                try:
-                    msg = self._read_lsp_response(proc)
-                    message_read = True
-                except Exception as e:
-                    self.logger.debug(
-                        f"Exception while waiting for clangd indexing: {e}"
-                    )
-                    break
-                # Only interested in $/progress notifications
-                if msg.get("method") == "$/progress":
-                    params = msg.get("params", {})
-                    token = params.get("token")
-                    value = params.get("value", {})
-                    if token == "backgroundIndexProgress" and isinstance(value, dict):
-                        percentage = value.get("percentage")
-                        if percentage is not None:
-                            # self.logger.debug(f"clangd indexing progress: {percentage}%")
-                            if percentage == 100:
-                                return
-                            if last_percentage == percentage and last_value == value:
-                                # No progress since last check
-                                waited += current_interval
-                                if current_interval >= max_stale_time:
-                                    self.logger.error(
-                                        f"No progress in {max_stale_time} seconds, giving up."
-                                    )
-                                    return
-                            else:
-                                waited = 0
-                                current_interval = interval
-                            last_percentage = percentage
-                            last_value = value
-                        else:
-                            # No percentage, just continue
-                            self.logger.debug(
-                                f"Received backgroundIndexProgress without percentage: {json.dumps(value, indent=2)}"
-                            )
-                            pass
-                    else:
-                        # Not a backgroundIndexProgress, just continue
-                        self.logger.debug(
-                            f"Received $/progress with token {token} but not backgroundIndexProgress: {json.dumps(msg, indent=2)}"
-                        )
-                        pass
-                else:
-                    # Not a $/progress message, just continue
-                    self.logger.debug(
-                        f"Received non-progress message: {json.dumps(msg, indent=2)}"
-                    )
-                    pass
-            # If no message was read, sleep with exponential backoff
-            if not message_read:
-                time.sleep(current_interval)
-                current_interval = min(current_interval * 2, max_interval)
-                waited += current_interval
-        if time.time() - start_time >= max_total_wait:
-            self.logger.warning(
-                f"Clangd indexing did not complete within {max_total_wait} seconds, giving up."
+        loc = resp["result"][0]
+        def_file = uri_to_path(loc["uri"])
+
+        if loc["uri"] not in def_symbols:
+            return None
+
+        def_symbol = def_symbols[loc["uri"]].get(ident)
+
+        if def_symbol:
+            start = def_symbol["location"]["range"]["start"]["line"]
+            end = def_symbol["location"]["range"]["end"]["line"]
+        else:
+            self.logger.debug(
+                f"Definition for {ident}, {lnum}, {col} not found in {def_file}."
             )
+            start = loc["range"]["start"]["line"]
+            end = loc["range"]["end"]["line"]
 
-    def trick_clangd(
-        self, proc: subprocess.Popen[Any], file_adds: Dict[str, Set[int]]
-    ) -> None:
-        """Trick clangd into indexing definitions by making a dummy pass and reading messages for 15 seconds."""
-        # Dummy query: open the first file if any
-        first_file = next(iter(file_adds), None)
-        if first_file:
-            abs_path = os.path.join(KERNEL_PATH, first_file)
-            if os.path.exists(abs_path):
-                file_lines = self._get_file_lines(abs_path)
-                if file_lines:
-                    self._open_file_in_lsp(
-                        proc, f"file://{abs_path}", "".join(file_lines)
-                    )
+        return (def_file, start, end)
+
+    def _open_definition_cache(self) -> None:
+        """Open the on-disk definition cache, creating it if needed."""
+        # Shared by the LSP workers, which serialize their access with the lock
+        self._def_cache = sqlite3.connect(
+            self.DEFINITION_CACHE_PATH, timeout=30, check_same_thread=False
+        )
+        self._def_cache_lock = threading.Lock()
+        # What clangd resolves depends on every header and on the config, so
+        # rows are only valid for the tree and make variables they were
+        # resolved in
+        self._def_cache_tree = hashlib.sha1(
+            "\n".join([self.rebase_commit.tree.hexsha, *self.MAKE_VARIABLES]).encode()
+        ).digest()
+        self._def_cache.execute("""
+            CREATE TABLE IF NOT EXISTS tree_definitions (
+                tree_key BLOB,
+                src_sha BLOB,
+                ident TEXT,
+                line INTEGER,
+                col INTEGER,
+                def_file TEXT,
+                def_sha BLOB,
+                start_line INTEGER,
+                end_line INTEGER,
+                PRIMARY KEY (tree_key, src_sha, ident, line, col)
+            )
+            """)
+        self._file_shas: Dict[str, Optional[bytes]] = {}
+
+    def _file_sha1(self, file_path: str) -> Optional[bytes]:
+        """SHA-1 of a file's contents, computed once per run."""
+        if file_path not in self._file_shas:
+            try:
+                with open(file_path, "rb") as f:
+                    self._file_shas[file_path] = hashlib.sha1(f.read()).digest()
+            except OSError:
+                self._file_shas[file_path] = None
+        return self._file_shas[file_path]
+
+    def _get_cached_definition(
+        self, src_sha: bytes, ident: str, line: int, col: int
+    ) -> Optional[Tuple[str, int, int]]:
+        """Look up a definition resolved by a previous run of the same tree."""
+        with self._def_cache_lock:
+            row = self._def_cache.execute(
+                "SELECT def_file, def_sha, start_line, end_line FROM tree_definitions "
+                "WHERE tree_key = ? AND src_sha = ? AND ident = ? AND line = ? AND col = ?",
+                (self._def_cache_tree, src_sha, ident, line, col),
+            ).fetchone()
+        if row is None:
+            return None
+
+        rel_def_file, def_sha, start, end = row
+        # Paths are stored relative to the kernel tree so that worktrees share them
+        def_file = os.path.normpath(os.path.join(self.kernel_path, rel_def_file))
+        # The cached range is only valid while the defining file is unchanged
+        if self._file_sha1(def_file) != def_sha:
+            return None
+        return (def_file, start, end)
 
-        self.wait_for_clangd_indexing(proc)
-        # Read LSP messages for 15 seconds
-        # start_time = time.time()
-        # while time.time() - start_time < 15:
-        #     try:
-        #         self._read_lsp_response(proc)
-        #     except Exception as e:
-        #         self.logger.debug(f"Exception while reading LSP response: {e}")
-        #         # break
+    def _cache_definition(
+        self,
+        src_sha: bytes,
+        ident: str,
+        line: int,
+        col: int,
+        def_loc: Tuple[str, int, int],
+    ) -> None:
+        """Store a resolved definition for later runs."""
+        def_file, start, end = def_loc
+        def_sha = self._file_sha1(def_file)
+        if def_sha is None:
+            return
+        with self._def_cache_lock:
+            self._def_cache.execute(
+                "INSERT OR REPLACE INTO tree_definitions "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self._def_cache_tree,
+                    src_sha,
+                    ident,
+                    line,
+                    col,
+                    self._rel_path(def_file),
+                    def_sha,
+                    start,
+                    end,
+                ),
+            )
 
     def _collect_definitions(
-        self, file_adds: Dict[str, Set[int]]
+        self, file_adds: Dict[str, List[Tuple[int, int]]]
     ) -> Dict[str, List[Tuple[int, int, str]]]:
-        """Collect all definitions from the diff using LSP, but wait after a dummy pass before real querying."""
-        # Start the LSP client and make a dummy query to trigger indexing
-        proc = self._setup_lsp_client()
-
-        # self.trick_clangd(proc, file_adds)
-
-        # import psutil
-        # max_wait = 10
-        # interval = 5
-        # waited = 0
-        # while waited < max_wait:
-        #     try:
-        #         self.logger.debug(f"pid: {proc.pid}, waiting for clangd-19 to index files...")
-        #         p = psutil.Process(proc.pid)
-        #         parent_pid = p.ppid()
-        #         sibling_procs = [s for s in psutil.process_iter(['pid', 'ppid', 'name', 'cmdline'])
-        #                          if s.info['ppid'] == parent_pid]
-        #         sibling_pids = [s.info['pid'] for s in sibling_procs]
-        #         self.logger.debug(f"Sibling PIDs (same parent as clangd-19 proc {proc.pid}, parent {parent_pid}): {sibling_pids}")
-        #     except Exception as e:
-        #         self.logger.debug(f"Error listing sibling processes: {e}")
-        #     time.sleep(interval)
-        #     waited += interval
-
-        # Now process all identifiers as normal
-        printed_defs: Set[str] = set()
-        printed_locations: Set[Tuple[str, int, int]] = set()
+        """
+        Collect all definitions from the diff using LSP, sharding the files
+        across up to MAX_LSP_WORKERS clangd processes.
+        """
+        # Kconfig, Makefiles, device trees, docs, etc. are left to the diff
+        file_adds = {
+            filename: add_ranges
+            for filename, add_ranges in file_adds.items()
+            if os.path.splitext(filename)[1] in self.SOURCE_EXTENSIONS
+        }
+        if not file_adds:
+            return {}
+
+        # Every worker owns its clangd, and they share the on-disk index
+        n_workers = max(1, min(self.MAX_LSP_WORKERS, NPROC, len(file_adds)))
+        procs = [self._setup_lsp_client(worker) for worker in range(n_workers)]
+
+        files = list(file_adds.items())
+
+        def _process_shard(
+            proc: subprocess.Popen[Any], shard: List[Tuple[str, List[Tuple[int, int]]]]
+        ) -> Dict[str, List[Tuple[int, int, str]]]:
+            printed_defs: Set[str] = set()
+            printed_locations: Set[Tuple[str, int, int]] = set()
+            shard_defs: Dict[str, List[Tuple[int, int, str]]] = {}
+            self._open_files_in_lsp(proc, [filename for filename, _ in shard])
+            for filename, add_ranges in shard:
+                self._process_file_identifiers(
+                    proc,
+                    filename,
+                    add_ranges,
+                    shard_defs,
+                    printed_defs,
+                    printed_locations,
+                )
+            return shard_defs
+
         collected_defs: Dict[str, List[Tuple[int, int, str]]] = {}
-        for filename, lines in file_adds.items():
-            self._process_file_identifiers(
-                proc, filename, lines, collected_defs, printed_defs, printed_locations
-            )
-        proc.terminate()
+        self._open_definition_cache()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_workers
+            ) as executor:
+                shards = [files[worker::n_workers] for worker in range(n_workers)]
+                for shard_defs in executor.map(_process_shard, procs, shards):
+                    for def_file, defs in shard_defs.items():
+                        collected_defs.setdefault(def_file, []).extend(defs)
+        finally:
+            self._def_cache.close()
+            for proc in procs:
+                proc.terminate()
         return collected_defs
 
-    def process_diff_and_print_definitions(self, diff_lines: List[str]) -> None:
+    def process_diff_and_print_definitions(self, diff_lines: Iterable[str]) -> None:
         """Process diff and collect definitions for context building."""
         file_adds = self.parse_diff(diff_lines)
         if not file_adds:
@@ -1044,57 +1413,106 @@ regulator-name.
         collected_defs = self._collect_definitions(file_adds)
         self.context = self._merge_and_build_context(collected_defs, file_adds)
 
-    def delete_cache(self) -> None:
-        """Remove the .cache directory under KERNEL_PATH"""
-        import os
-
-        cache_dir = os.path.join(KERNEL_PATH, ".cache")
-        try:
-            import shutil
+    @classmethod
+    def delete_cache(cls, kernel_path: "os.PathLike[str]" = KERNEL_PATH) -> None:
+        """
+        Remove clangd's persistent index and any .cache left in the kernel tree.
+        Reviews index into the shared CLANGD_CACHE_PATH, so this must not run
+        while any of them may be running.
+        """
+        logger = cls.get_logger()
+        for cache_dir in (
+            cls.CLANGD_CACHE_PATH,
+            os.path.join(kernel_path, ".cache"),
+        ):
+            try:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                logger.debug(f"Removed cache directory: {cache_dir}")
+            except Exception as e:
+                logger.error(f"Failed to remove cache directory {cache_dir}: {e}")
 
-            shutil.rmtree(cache_dir, ignore_errors=True)
-            self.logger.debug(f"Removed cache directory: {cache_dir}")
-        except Exception as e:
-            self.logger.error(f"Failed to remove cache directory {cache_dir}: {e}")
+    def _link_clangd_cache(self) -> None:
+        """
+        clangd keeps its background index in a .cache directory next to
+        compile_commands.json. The build directory is per commit, so point
+        its .cache at the persistent CLANGD_CACHE_PATH.
+        """
+        self.CLANGD_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+        cache_link = self.build_dir / ".cache"
+        if cache_link.is_symlink():
+            if cache_link.resolve() == self.CLANGD_CACHE_PATH.resolve():
+                return
+            cache_link.unlink()
+        elif cache_link.exists():
+            shutil.rmtree(cache_link, ignore_errors=True)
+        cache_link.symlink_to(self.CLANGD_CACHE_PATH, target_is_directory=True)
 
     def get_context(self) -> None:
         """Generate context for the AI review."""
-        self.delete_cache()  # TEMP DELETE
+        self._link_clangd_cache()
 
         self.generate_compile_commands()  # TEMP uncomment
         if not hasattr(self, "context"):
             self.context = ""
-        # Split self.diff into lines and strip trailing newlines
-        diff_lines = [line.rstrip("\n") for line in self.diff.splitlines()]
-        self.process_diff_and_print_definitions(diff_lines)
+        # The full diff is kept for the prompt, parse_diff only needs its lines
+        # which splitlines() already returns without their newlines
+        self.process_diff_and_print_definitions(self.diff.splitlines())
         self.logger.debug(f"Context after processing diff: {self.context}")
 
     def setup(self) -> None:
         super().setup()
+        # LSP message ids are unique across all clangd processes
+        self._msg_ids = itertools.count(self.INIT_MSG_ID + 1)
+        self._opened_uris: Dict[subprocess.Popen[Any], Set[str]] = {}
+        self._rx_bufs: Dict[subprocess.Popen[Any], bytearray] = {}
+        self._rel_paths: Dict[str, str] = {}
+        # (path, function start line) -> identifier -> declaring line
+        self._local_declarations: Dict[Tuple[str, int], Dict[str, int]] = {}
+        self._exists_cache: Dict[str, bool] = {}
+        # path -> (mtime, size, content) in least recently used order
+        self._file_cache: OrderedDict[str, Tuple[int, int, str]] = OrderedDict()
+        self._file_cache_lock = threading.Lock()
+        # uri -> (mtime, symbols by name), shared by all clangd processes
+        self._doc_symbol_cache: Dict[str, Tuple[int, Dict[str, Dict[str, Any]]]] = {}
+        # The prompts and clangd's stderr are written into the sandbox
+        SANDBOX_PATH.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def _write_sandbox_file(cls, name: str, content: str) -> None:
+        """
+        Write a debug file into the sandbox, unless this process already
+        wrote the same content to it.
+        """
+        path = SANDBOX_PATH / name
+        digest = hashlib.blake2b(content.encode()).digest()
+        if cls._sandbox_file_digests.get(name) == digest and path.exists():
+            return
+        with open(path, "w") as f:
+            f.write(content)
+        cls._sandbox_file_digests[name] = digest
 
     def run(self) -> str:
         """Execute the AI code review."""
         self.get_context()
 
-        formatted_prompt = self.PROMPT_TEMPLATE.format(
-            diff=self.diff, commit_text=self.commit_message, context=self.context
+        formatted_prompt = self.format_prompt(
+            self.PROMPT_TEMPLATE,
+            diff=self.diff,
+            commit_text=self.commit_message,
+            context=self.context,
         )
 
         # self.logger.debug(f"System prompt:\n{self.get_system_prompt()}") # TEMP
         self.logger.debug(f"Formatted prompt for AI review:\n{formatted_prompt}")
 
         # Write prompts to sandbox for debugging
-        prompt_path = os.path.join(SANDBOX_PATH, "prompt.md")
-        with open(prompt_path, "w") as f:
-            f.write(formatted_prompt)
-
-        system_prompt_path = os.path.join(SANDBOX_PATH, "system_prompt.md")
-        with open(system_prompt_path, "w") as f:
-            f.write(self.get_system_prompt())
+        system_prompt = self.get_system_prompt()
+        self._write_sandbox_file("prompt.md", formatted_prompt)
+        self._write_sandbox_file("system_prompt.md", system_prompt)
 
         result = self.provider_api_call(
             user_prompt=formatted_prompt,
-            system_prompt=self.get_system_prompt(),
+            system_prompt=system_prompt,
         )
 
         return self.format_chat_response(result)
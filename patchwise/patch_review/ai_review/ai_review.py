@@ -2,112 +2,155 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
+import functools
 import os
 import re
+import string
 import textwrap
+import threading
 import typing as t
 
-import httpx
-import litellm
-import urllib3
-
-urllib3.disable_warnings()
-
 from patchwise.patch_review.patch_review import PatchReview
 
+if t.TYPE_CHECKING:
+    import httpx
+
 DEFAULT_MODEL = "Pro"
 DEFAULT_API_BASE = "https://api.openai.com/v1"
 
+# Lines that start a paragraph of their own when wrapping a chat response
+BULLET_RE = re.compile(
+    r"""
+    ^\s*                              # Optional leading whitespace
+    (
+        [*+\->]                       # Unordered bullet characters
+        |                             # OR
+        \d+[.)-]                      # Numbered bullets like 1. or 2)
+        |                             # OR
+        \d+(\.\d+)+                   # Decimal bullets like 1.1 or 1.2.3
+    )
+    \s*                               # At least one space after the bullet
+""",
+    re.VERBOSE,
+)
+
+# Tags from the Kernel documentation
+# https://www.kernel.org/doc/html/latest/process/submitting-patches.html
+# and additional tags like "Change-Id". A tuple so that str.startswith() can
+# check all of them in one call.
+COMMIT_TAGS = (
+    # Upstream tags
+    "Acked-by:",
+    "Cc:",
+    "Closes:",
+    "Co-developed-by:",
+    "Fixes:",
+    "From:",
+    "Link:",
+    "Reported-by:",
+    "Reviewed-by:",
+    "Signed-off-by:",
+    "Suggested-by:",
+    "Tested-by:",
+    # Additional tags
+    "(cherry picked from commit",
+    "Change-Id",
+    "Git-Commit:",
+    "Git-repo",
+    "Git-Repo:",
+)
+
+# Only the tags sharing a paragraph's first character need to be compared
+COMMIT_TAGS_BY_FIRST_CHAR = {
+    char: tuple(tag for tag in COMMIT_TAGS if tag[0] == char)
+    for char in {tag[0] for tag in COMMIT_TAGS}
+}
+
+
+@functools.cache
+def _parse_prompt_template(template: str) -> tuple[tuple[str, str | None], ...]:
+    """Splits a prompt template into (literal text, field name) pairs once."""
+    return tuple(
+        (literal, field) for literal, field, _, _ in string.Formatter().parse(template)
+    )
+
 
 class AiReview(PatchReview):
     model: str = DEFAULT_MODEL
     api_base: str = DEFAULT_API_BASE
+    # Shared by every AI review so that calls reuse pooled connections
+    _http_client: t.Optional["httpx.Client"] = None
+    _http_client_lock = threading.Lock()
+
+    @classmethod
+    def _get_http_client(cls) -> "httpx.Client":
+        """Returns the HTTP client of the LLM API, creating it on first use."""
+        with AiReview._http_client_lock:
+            if AiReview._http_client is None:
+                import httpx
+
+                AiReview._http_client = httpx.Client(
+                    verify=False,
+                    limits=httpx.Limits(
+                        max_keepalive_connections=8, keepalive_expiry=60.0
+                    ),
+                )
+            return AiReview._http_client
+
+    @staticmethod
+    def format_prompt(template: str, **fields: str) -> str:
+        """
+        Equivalent to template.format(**fields) for templates with plain
+        {field} placeholders, but the template is only parsed once.
+        """
+        parts: list[str] = []
+        for literal, field in _parse_prompt_template(template):
+            parts.append(literal)
+            if field is not None:
+                parts.append(fields[field])
+        return "".join(parts)
 
     def format_chat_response(self, text: str) -> str:
         """
         Line wraps the given text at 75 columns but skips commit tags.
         """
 
-        def split_text_into_paragraphs(text: str) -> list[str]:
+        def iter_paragraphs(text: str) -> t.Iterator[str]:
             """
-            Splits the input text into paragraphs, treating each bullet
+            Yields the paragraphs of the input text, treating each bullet
             point line as a separate paragraph.
             """
-            lines = text.split("\n")
-            paragraphs = []
-            current = []
-            bullet_pattern = re.compile(
-                r"""
-                ^\s*                              # Optional leading whitespace
-                (
-                    [*+\->]                       # Unordered bullet characters
-                    |                             # OR
-                    \d+[.)-]                      # Numbered bullets like 1. or 2)
-                    |                             # OR
-                    \d+(\.\d+)+                   # Decimal bullets like 1.1 or 1.2.3
-                )
-                \s*                               # At least one space after the bullet
-            """,
-                re.VERBOSE,
-            )
-
-            for line in lines:
+            current: list[str] = []
+            # Unlike splitlines(), a trailing newline still ends in an empty
+            # paragraph
+            for line in text.split("\n"):
                 line_stripped = line.strip()
                 if (
                     line_stripped == ""
                     or line_stripped == "```"
                     or line_stripped == "'''"
                     or line_stripped == '"""'
-                    or bullet_pattern.match(line_stripped) is not None
+                    or BULLET_RE.match(line_stripped) is not None
                 ):
-                    if len(current) > 0:
-                        paragraphs.append("\n".join(current))
+                    if current:
+                        yield "\n".join(current)
                         current = []
-                    paragraphs.append(line)
+                    yield line
                 else:
                     current.append(line)
-            if len(current) > 0:
-                paragraphs.append("\n".join(current))
-
-            return paragraphs
+            if current:
+                yield "\n".join(current)
 
         def is_commit_tag(text: str) -> bool:
             """
-            Checks if the given text starts with a commit tag.
-            The TAGS list includes tags from the Kernel documentation
-            https://www.kernel.org/doc/html/latest/process/submitting-patches.html
-            and additional tags like "Change-Id".
+            Checks if the given text starts with one of COMMIT_TAGS.
             """
-            TAGS = {
-                # Upstream tags
-                "Acked-by:",
-                "Cc:",
-                "Closes:",
-                "Co-developed-by:",
-                "Fixes:",
-                "From:",
-                "Link:",
-                "Reported-by:",
-                "Reviewed-by:",
-                "Signed-off-by:",
-                "Suggested-by:",
-                "Tested-by:",
-                # Additional tags
-                "(cherry picked from commit",
-                "Change-Id",
-                "Git-Commit:",
-                "Git-repo",
-                "Git-Repo:",
-            }
-
-            return any(text.startswith(tag) for tag in TAGS)
+            return text.startswith(COMMIT_TAGS_BY_FIRST_CHAR.get(text[:1], ()))
 
         def is_quote(text):
             return text.startswith(">")
 
-        paragraphs = split_text_into_paragraphs(text)
-
-        wrapped_paragraphs = [
+        return "\n".join(
             (
                 textwrap.fill(
                     p,
@@ -117,14 +160,14 @@ class AiReview(PatchReview):
                 if not (is_commit_tag(p.strip()) or is_quote(p.strip()))
                 else p
             )
-            for p in paragraphs
-        ]
-
-        return "\n".join(wrapped_paragraphs)
+            for p in iter_paragraphs(text)
+        )
 
     def provider_api_call(
         self, user_prompt: str, system_prompt: t.Optional[str] = None
     ) -> str:
+        import litellm
+
         messages = [{"content": user_prompt, "role": "user"}]
         if system_prompt:
             messages.append({"content": system_prompt, "role": "system"})
@@ -143,17 +186,25 @@ class AiReview(PatchReview):
         return response.choices[0].message.content
 
     def setup(self):
+        # The LLM client stack is slow to import, so only load it once an AI
+        # review is actually set up
+        import litellm
+        import urllib3
+
+        urllib3.disable_warnings()
+
         self.model = AiReview.model
 
         os.environ["OTEL_SDK_DISABLED"] = "true"
 
-        litellm.client_session = httpx.Client(verify=False)
+        litellm.client_session = self._get_http_client()
 
         self.diff = self.repo.git.diff(self.base_commit, self.commit).strip()
         if not self.diff:
             self.logger.error("Failed to retrieve diff.")
 
-        self.commit_message = self.repo.commit(self.commit).message.rstrip()
+        # self.commit is already resolved, no need to look it up in the kernel tree
+        self.commit_message = self.commit.message.rstrip()
         if not self.commit_message:
             self.logger.error("Failed to retrieve commit message.")
 
@@ -171,6 +222,11 @@ def add_ai_arguments(
         default=DEFAULT_API_BASE,
         help="The base URL for the AI model API. (default: %(default)s)",
     )
+    parser_or_group.add_argument(
+        "--purge-clangd-cache",
+        action="store_true",
+        help="Discard clangd's persistent background index and rebuild it from scratch.",
+    )
     # parser_or_group.add_argument(
     #     "--review-threshold",
     #     type=float,
@@ -186,3 +242,9 @@ def apply_ai_args(args: argparse.Namespace) -> None:
     """
     AiReview.model = args.model
     AiReview.api_base = args.provider
+
+    # Purged before any review, or any --jobs worker, can index into it
+    if args.purge_clangd_cache:
+        from .ai_code_review import AiCodeReview
+
+        AiCodeReview.delete_cache()
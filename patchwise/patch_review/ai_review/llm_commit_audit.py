@@ -10,6 +10,8 @@ from .ai_review import AiReview
 @register_short_review
 class LLMCommitAudit(AiReview):
     DEPENDENCIES = getattr(AiReview, "DEPENDENCIES", [])
+    # run() only needs the diff and commit message captured in setup()
+    TREE_INDEPENDENT_RUN = True
 
     PROMPT_TEMPLATE = """
 **Prompt:**
@@ -47,7 +49,8 @@ The output should use only ASCII characters.
         super().setup()
 
     def run(self) -> str:
-        formatted_prompt = LLMCommitAudit.PROMPT_TEMPLATE.format(
+        formatted_prompt = self.format_prompt(
+            LLMCommitAudit.PROMPT_TEMPLATE,
             diff=self.diff,
             commit_text=str(self.commit_message),
         )
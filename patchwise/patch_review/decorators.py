@@ -1,18 +1,22 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
-from typing import Any, List, Type
-
-from .ai_review.ai_review import AiReview
-from .patch_review import PatchReview
-from .static_analysis.static_analysis import StaticAnalysis
-
-# Registries for different review types
-AVAILABLE_PATCH_REVIEWS: List[Type[PatchReview]] = []
-LLM_REVIEWS: List[Type[AiReview]] = []
-STATIC_ANALYSIS_REVIEWS: List[Type[StaticAnalysis]] = []
-SHORT_REVIEWS: List[Type[PatchReview]] = []
-LONG_REVIEWS: List[Type[PatchReview]] = []
+from typing import TYPE_CHECKING, Any, List, Type
+
+if TYPE_CHECKING:
+    # Only needed for annotations; importing AiReview at runtime would pull
+    # the LLM stack into every static analysis review module
+    from .ai_review.ai_review import AiReview
+    from .patch_review import PatchReview
+    from .static_analysis.static_analysis import StaticAnalysis
+
+# Registries for different review types. Reviews are imported lazily through
+# registry.REVIEW_MODULES, so these only list the reviews loaded so far.
+AVAILABLE_PATCH_REVIEWS: List[Type["PatchReview"]] = []
+LLM_REVIEWS: List[Type["AiReview"]] = []
+STATIC_ANALYSIS_REVIEWS: List[Type["StaticAnalysis"]] = []
+SHORT_REVIEWS: List[Type["PatchReview"]] = []
+LONG_REVIEWS: List[Type["PatchReview"]] = []
 
 
 # Decorators for each review type
@@ -3,6 +3,7 @@
 
 import logging
 import shutil
+import threading
 from pathlib import Path
 
 from git import GitCommandError, RemoteProgress, Repo
@@ -15,6 +16,9 @@ logger = logging.getLogger(__name__)
 
 BRANCH_NAME = f"{PACKAGE_NAME}-linux-next-stable"
 
+# Serializes worktree creation between concurrently running reviews
+_worktree_lock = threading.Lock()
+
 
 class TqdmFetchProgress(RemoteProgress):
     def __init__(self):
@@ -83,6 +87,22 @@ def init_kernel_tree(path: Path = KERNEL_PATH) -> Repo:
     return repo
 
 
+def _is_worktree(repo: Repo, path: Path) -> bool:
+    """
+    Check whether path is registered as a worktree of repo.
+    """
+    try:
+        worktrees = repo.git.worktree("list", "--porcelain").split("\n")
+        for line in worktrees:
+            if line.startswith("worktree "):
+                wt_path = line.split(" ", 1)[1].strip()
+                if Path(wt_path).resolve() == path.resolve():
+                    return True
+    except GitCommandError as e:
+        logger.warning(f"Could not list worktrees: {e}")
+    return False
+
+
 def create_git_worktree(
     repo: Repo, branch_name: str = BRANCH_NAME, worktree_path: Path = KERNEL_PATH
 ):
@@ -100,19 +120,7 @@ def create_git_worktree(
 
     # Check if the path exists and if it's a worktree
     if worktree_path.exists():
-        is_worktree = False
-        try:
-            worktrees = repo.git.worktree("list", "--porcelain").split("\n")
-            for line in worktrees:
-                if line.startswith("worktree "):
-                    wt_path = line.split(" ", 1)[1].strip()
-                    if Path(wt_path).resolve() == worktree_path.resolve():
-                        is_worktree = True
-                        break
-        except GitCommandError as e:
-            logger.warning(f"Could not list worktrees: {e}")
-
-        if is_worktree:
+        if _is_worktree(repo, worktree_path):
             logger.info(f"Worktree already exists at {worktree_path}")
             return
         else:
@@ -128,3 +136,60 @@ def create_git_worktree(
     except GitCommandError as e:
         logger.error(f"Failed to create worktree: {e}")
         raise
+
+
+def _add_detached_worktree(
+    repo: Repo, worktree_path: Path, branch_name: str = BRANCH_NAME
+) -> None:
+    """
+    Create a detached worktree of branch_name at worktree_path, reusing it if
+    it already exists.
+    """
+    with _worktree_lock:
+        if worktree_path.exists():
+            if _is_worktree(repo, worktree_path):
+                logger.info(f"Worktree already exists at {worktree_path}")
+                return
+            logger.info(
+                f"Directory {worktree_path} exists but is not a worktree, removing it."
+            )
+            shutil.rmtree(worktree_path)
+
+        # A branch can only be checked out in one worktree, so detach the others
+        try:
+            repo.git.worktree("add", "--detach", str(worktree_path), branch_name)
+            logger.info(f"Created worktree at {worktree_path} for branch {branch_name}")
+        except GitCommandError as e:
+            logger.error(f"Failed to create worktree: {e}")
+            raise
+
+
+def create_worker_worktrees(
+    repo: Repo, count: int, branch_name: str = BRANCH_NAME
+) -> list[Path]:
+    """
+    Return count kernel worktrees so that commits can be reviewed concurrently.
+    The first one is the main worktree at KERNEL_PATH, which must already have
+    been created by create_git_worktree(). The others are detached worktrees
+    next to it, created on first use and reused afterwards.
+    """
+    worktree_paths = [KERNEL_PATH]
+    for idx in range(1, count):
+        worktree_path = KERNEL_PATH.with_name(f"{KERNEL_PATH.name}-{idx}")
+        worktree_paths.append(worktree_path)
+        _add_detached_worktree(repo, worktree_path, branch_name)
+
+    return worktree_paths
+
+
+def create_base_worktree(
+    repo: Repo, kernel_path: Path = KERNEL_PATH, branch_name: str = BRANCH_NAME
+) -> Path:
+    """
+    Return the worktree that base commits are built in while the commit under
+    review is built in kernel_path. It is a detached worktree next to
+    kernel_path, created on first use and reused afterwards.
+    """
+    worktree_path = kernel_path.with_name(f"{kernel_path.name}-base")
+    _add_detached_worktree(repo, worktree_path, branch_name)
+    return worktree_path
@@ -2,15 +2,18 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import abc
+import functools
 import inspect
 import logging
 import os
 import re
+import selectors
 import shutil
 import subprocess
 import sys
 import time
-from typing import Any, List, Union
+from pathlib import Path
+from typing import Any, Iterator, List, Union
 
 from git import Repo
 from git.exc import GitCommandError
@@ -23,6 +26,111 @@ from .kernel_tree import BRANCH_NAME
 
 PATCH_PATH = PACKAGE_PATH / "patches"
 BUILD_DIR = SANDBOX_PATH / "build"
+# CPUs this process may run on, which unlike os.cpu_count() honours the
+# affinity mask a container or taskset restricts it to
+NPROC = (
+    len(os.sched_getaffinity(0))
+    if hasattr(os, "sched_getaffinity")
+    else (os.cpu_count() or 1)
+)
+
+
+@functools.cache
+def get_kernel_repo(kernel_path: Path = KERNEL_PATH) -> Repo:
+    """
+    Returns the Repo of a kernel worktree, opening it only once so that every
+    review of every commit shares its config and object database.
+    """
+    return Repo(kernel_path)
+
+
+@functools.lru_cache(maxsize=64)
+def get_modified_files(commit: Commit) -> tuple[str, ...]:
+    """
+    Returns the paths changed by commit, relative to the top of the tree.
+    Every access to Commit.stats runs git diff, so reviews of the same
+    commit share a single run.
+    """
+    return tuple(str(path) for path in commit.stats.files.keys())
+
+
+@functools.cache
+def _parse_version(version: str) -> Version:
+    """Parses a version, once per distinct string since many tools share them."""
+    return Version(version)
+
+
+@functools.cache
+def _get_tool_version(cmd_path: str, mtime_ns: int) -> Version:
+    """
+    Returns the version an executable reports, running it only once unless
+    it has been replaced since, e.g. by an install.
+    """
+    out = subprocess.check_output([cmd_path, "--version"], text=True)
+    match = re.search(r"(\d+\.\d+\.\d+)", out)
+    return _parse_version(match.group(1))
+
+
+@functools.cache
+def _get_llvm_install(cmd_path: str, mtime_ns: int) -> tuple[Version, Path] | None:
+    """
+    Returns the version and bin directory of the LLVM install that the
+    llvm-config at cmd_path belongs to, querying both with a single run.
+    """
+    out = subprocess.check_output([cmd_path, "--version", "--bindir"], text=True)
+    lines = out.splitlines()
+    match = re.search(r"(\d+\.\d+\.\d+)", lines[0]) if len(lines) == 2 else None
+    if match is None:
+        return None
+    return _parse_version(match.group(1)), Path(lines[1]).resolve()
+
+
+# (package manager, command run before installing, install command without
+# the package name), in the order they are tried
+PKG_MANAGERS: list[tuple[str, list[str] | None, list[str]]] = [
+    (
+        "apt-get",
+        ["sudo", "apt-get", "update"],
+        ["sudo", "apt-get", "install", "-y"],
+    ),
+    ("dnf", None, ["sudo", "dnf", "install", "-y"]),
+    ("yum", None, ["sudo", "yum", "install", "-y"]),
+    ("zypper", None, ["sudo", "zypper", "install", "-y"]),
+    ("pacman", None, ["sudo", "pacman", "-Sy"]),
+]
+
+
+@functools.cache
+def _get_available_pkg_managers() -> list[tuple[list[str] | None, list[str]]]:
+    """Returns the commands of the package managers installed on this host."""
+    return [
+        (pre, install_cmd)
+        for mgr, pre, install_cmd in PKG_MANAGERS
+        if shutil.which(mgr)
+    ]
+
+
+@functools.cache
+def _get_patch_files(subdir: str) -> tuple[Path, ...]:
+    """
+    Returns the patches in a PATCH_PATH subdirectory in the order they are
+    applied. They do not change during a run, so each directory is only
+    listed once.
+    """
+    return tuple(sorted((PATCH_PATH / subdir).glob("*.patch")))
+
+
+def _decode_output(data: bytes | bytearray) -> str:
+    """Decodes command output the way a text mode pipe would."""
+    text = data.decode(errors="replace")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+# (name, min_version, max_version) of every dependency that passed check(),
+# shared by all reviews since several of them depend on the same tools
+_CHECKED_DEPENDENCIES: set[tuple[str, str | None, str | None]] = set()
 
 
 class Dependency:
@@ -39,25 +147,48 @@ class Dependency:
         self.min_version: Version | None = None
         self.max_version: Version | None = None
         if min_version is not None:
-            self.min_version = Version(str(min_version))
+            self.min_version = _parse_version(str(min_version))
         if max_version is not None:
-            self.max_version = Version(str(max_version))
+            self.max_version = _parse_version(str(max_version))
 
     def version_in_range(self, version: Version) -> bool:
+        if self.min_version is None and self.max_version is None:
+            return True
         if (self.min_version is not None and version < self.min_version) or (
             self.max_version is not None and version > self.max_version
         ):
             return False
         return True
 
-    def get_version(self) -> Version:
-        out = subprocess.check_output([self.name, "--version"], text=True)
-        match = re.search(r"(\d+\.\d+\.\d+)", out)
-        version = Version(match.group(1))
+    def fast_version(self) -> Version | None:
+        """
+        Subclasses may override this to tell the version without running the
+        executable, returning None when it cannot be told that way.
+        """
+        return None
 
-        return version
+    def get_version(self) -> Version:
+        version = self.fast_version()
+        if version is not None:
+            return version
+        cmd_path = shutil.which(self.name) or self.name
+        return _get_tool_version(cmd_path, os.stat(cmd_path).st_mtime_ns)
+
+    def _check_key(self) -> tuple[str, str | None, str | None]:
+        return (
+            self.name,
+            str(self.min_version) if self.min_version is not None else None,
+            str(self.max_version) if self.max_version is not None else None,
+        )
 
     def check(self) -> None:
+        key = self._check_key()
+        if key in _CHECKED_DEPENDENCIES:
+            return
+        self._check()
+        _CHECKED_DEPENDENCIES.add(key)
+
+    def _check(self) -> None:
         cmd_path = shutil.which(self.name)
         if cmd_path is None or not os.access(cmd_path, os.X_OK):
             raise ImportError(
@@ -90,26 +221,14 @@ class Dependency:
             )
 
     def install_from_pkg_manager(self) -> None:
-        pkg_managers: list[tuple[str, list[str] | None, list[str]]] = [
-            (
-                "apt-get",
-                ["sudo", "apt-get", "update"],
-                ["sudo", "apt-get", "install", "-y", self.name],
-            ),
-            ("dnf", None, ["sudo", "dnf", "install", "-y", self.name]),
-            ("yum", None, ["sudo", "yum", "install", "-y", self.name]),
-            ("zypper", None, ["sudo", "zypper", "install", "-y", self.name]),
-            ("pacman", None, ["sudo", "pacman", "-Sy", self.name]),
-        ]
-        for mgr, pre, install_cmd in pkg_managers:
-            if shutil.which(mgr):
-                try:
-                    if pre:
-                        subprocess.run(pre, check=True)
-                    subprocess.run(install_cmd, check=True)
-                    break
-                except Exception:
-                    continue
+        for pre, install_cmd in _get_available_pkg_managers():
+            try:
+                if pre:
+                    subprocess.run(pre, check=True)
+                subprocess.run([*install_cmd, self.name], check=True)
+                break
+            except Exception:
+                continue
 
     def _do_install(self) -> None:
         """
@@ -132,23 +251,73 @@ class Dependency:
             self.check()
 
 
+class LLVMDependency(Dependency):
+    """
+    A tool of an LLVM install, e.g. clang or ld.lld. All of them share the
+    version that llvm-config reports, so it only has to be run once for
+    every tool installed next to it.
+    """
+
+    def fast_version(self) -> Version | None:
+        llvm_config = shutil.which("llvm-config")
+        cmd_path = shutil.which(self.name)
+        if llvm_config is None or cmd_path is None:
+            return None
+        try:
+            llvm_install = _get_llvm_install(
+                llvm_config, os.stat(llvm_config).st_mtime_ns
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        if llvm_install is None:
+            return None
+        version, bindir = llvm_install
+        # Another install of the tool earlier in PATH has its own version
+        if Path(cmd_path).resolve().parent != bindir:
+            return None
+        return version
+
+
 class PatchReview(abc.ABC):
     # Subclasses must define a list of Dependency objects
     DEPENDENCIES: list[Dependency]
+    # Size of each read from the pipes of a command run by run_cmd_with_timer()
+    READ_CHUNK_SIZE = 64 * 1024
+    # (apply key, HEAD) after the last apply_patches() that fully succeeded
+    _applied: tuple | None = None
+    # Exit status of the last command run by run_cmd_with_timer() or
+    # run_cmd_lines(), which only return its output
+    returncode: int | None = None
+    # Whether commands draw a timer, which commands running concurrently on
+    # copies of a review would draw over each other
+    show_timer: bool = True
+    # Set by subclasses whose run() only uses state captured during setup(),
+    # allowing it to run while other reviews use the kernel tree
+    TREE_INDEPENDENT_RUN: bool = False
 
     @classmethod
     def get_logger(cls) -> logging.Logger:
         return logging.getLogger(f"{PACKAGE_NAME}.{cls.__name__.lower()}")
 
-    def __init__(self, commit: Commit, base_commit: Commit | None = None):
+    def __init__(
+        self,
+        commit: Commit,
+        base_commit: Commit | None = None,
+        kernel_path: Path = KERNEL_PATH,
+    ):
         self.logger = self.get_logger()
         self.__class__.verify_dependencies()
-        self.repo = Repo(KERNEL_PATH)
+        # The kernel worktree this review applies its patches to and runs in
+        self.kernel_path = kernel_path
+        self.repo = get_kernel_repo(kernel_path)
         self.commit = commit
         # The default for base_commit is the parent of the commit if not provided
         # TODO alternatively use FETCH_HEAD after a git fetch
         self.base_commit = base_commit or commit.parents[0]
-        self.build_dir = BUILD_DIR / str(self.commit.hexsha)
+        # Shared by every review of the commit. Reviews that configure the
+        # kernel build in a subdirectory of it per configuration.
+        self.build_root = BUILD_DIR / str(self.commit.hexsha)
+        self.build_dir = self.build_root
         self.build_dir.mkdir(parents=True, exist_ok=True)
         self.apply_patches([self.commit])
         self.rebase_commit = self.repo.head.commit
@@ -188,39 +357,68 @@ class PatchReview(abc.ABC):
             cls.get_logger().debug(f"{cls.__name__} dependencies are installed.")
             setattr(cls, "_dependencies_verified", True)
 
+    @property
+    def modified_files(self) -> tuple[str, ...]:
+        """The paths changed by the commit under review."""
+        return get_modified_files(self.commit)
+
     def git_abort(self) -> None:
         """
         Abort any ongoing git operations.
         """
         self.logger.debug("Attempting to abort any ongoing git operations.")
-        try:
-            self.repo.git.am("--abort")
-        except GitCommandError:
-            pass
-        try:
-            self.repo.git.rebase("--abort")
-        except GitCommandError:
-            pass
-        try:
-            self.repo.git.cherry_pick("--abort")
-        except GitCommandError:
-            pass
-        try:
-            self.repo.git.merge("--abort")
-        except GitCommandError:
-            pass
+        # Only abort what the worktree's state files say is in progress
+        # rather than running every abort and letting most of them fail
+        git_dir = Path(self.repo.git_dir)
+        rebase_apply = git_dir / "rebase-apply"
+        git = self.repo.git
+        ongoing = []
+        if rebase_apply.exists():
+            ongoing.append(
+                git.am if (rebase_apply / "applying").exists() else git.rebase
+            )
+        if (git_dir / "rebase-merge").exists():
+            ongoing.append(git.rebase)
+        if (git_dir / "CHERRY_PICK_HEAD").exists() or (git_dir / "sequencer").exists():
+            ongoing.append(git.cherry_pick)
+        if (git_dir / "MERGE_HEAD").exists():
+            ongoing.append(git.merge)
+
+        for abort in ongoing:
+            try:
+                abort("--abort")
+            except GitCommandError:
+                pass
+
+    def _apply_key(self, patch_files: tuple[Path, ...], commits: list[Commit]) -> tuple:
+        """Identifies everything apply_patches() puts on top of BRANCH_NAME."""
+        return (
+            str(self.repo.working_tree_dir),
+            self.repo.commit(BRANCH_NAME).hexsha,
+            patch_files,
+            tuple(commit.hexsha for commit in commits),
+        )
 
     def apply_patches(self, commits: list[Commit]) -> None:
+        general_patch_files = _get_patch_files("general")
+        review_patch_files = _get_patch_files(self.__class__.__name__.lower())
+        patch_files = general_patch_files + review_patch_files
+        cherry_commits = commits or [self.commit]
+
+        # Reviews apply the same commits again, e.g. in run() after __init__.
+        # Unless something else has moved HEAD since, the tree is already in
+        # that state.
+        key = self._apply_key(patch_files, cherry_commits)
+        if self._applied == (key, self.repo.head.commit.hexsha):
+            self.logger.debug("Patches are already applied, skipping")
+            return
+        self._applied = None
+
         self.git_abort()
         self.repo.git.switch(BRANCH_NAME, detach=True)
         self.logger.debug(f"Applying patches from {PATCH_PATH} on branch {BRANCH_NAME}")
-        general_patch_files = sorted((PATCH_PATH / "general").glob("*.patch"))
         self.logger.debug(f"Applying general patches: {general_patch_files}")
-        review_patch_files = sorted(
-            (PATCH_PATH / self.__class__.__name__.lower()).glob("*.patch")
-        )
         self.logger.debug(f"Applying review patches: {review_patch_files}")
-        patch_files = general_patch_files + review_patch_files
         for patch_file in patch_files:
             self.logger.debug(f"Applying patch: {patch_file}")
             try:
@@ -229,7 +427,7 @@ class PatchReview(abc.ABC):
                 self.logger.warning(f"Failed to apply patch {patch_file}: {e}")
                 self.repo.git.am("--skip")
 
-        cherry_commits = commits or [self.commit]
+        all_applied = True
         for cherry_commit in cherry_commits:
             self.logger.debug(f"Applying commit: {cherry_commit.hexsha}")
             try:
@@ -239,6 +437,11 @@ class PatchReview(abc.ABC):
                 self.logger.warning(
                     f"Failed to cherry-pick {cherry_commit.hexsha}: {e}"
                 )
+                all_applied = False
+
+        # A failed cherry-pick leaves the tree to be cleaned up by the next call
+        if all_applied:
+            self._applied = (key, self.repo.head.commit.hexsha)
 
     @abc.abstractmethod
     def setup(self) -> None:
@@ -247,6 +450,74 @@ class PatchReview(abc.ABC):
         """
         pass
 
+    def _stream_cmd_output(
+        self,
+        cmd: List[str],
+        desc: str,
+        cwd: str,
+        stdout: int | None,
+        stderr: int | None,
+        **kwargs: Any,
+    ) -> Iterator[tuple[int, bytes]]:
+        """
+        Runs a command while displaying a timer, yielding (stream, data) for
+        every chunk read from its pipes, where stream is 0 for stdout and 1
+        for stderr. The command is killed if the generator is not exhausted.
+        """
+        show_timer = self.show_timer and self.logger.isEnabledFor(logging.INFO)
+        start = time.monotonic()
+        shown_elapsed = -1
+
+        def _show_elapsed() -> None:
+            nonlocal shown_elapsed
+            elapsed = int(time.monotonic() - start)
+            # Only redraw the timer once it changed
+            if show_timer and elapsed != shown_elapsed:
+                shown_elapsed = elapsed
+                sys.stdout.write(f"\r{desc}... {elapsed}s elapsed")
+                sys.stdout.flush()
+
+        with subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            stdout=stdout,
+            stderr=stderr,
+            **kwargs,
+        ) as process:
+            # The pipes are drained as the command writes to them, waking up
+            # at least once a second to refresh the timer
+            try:
+                with selectors.DefaultSelector() as selector:
+                    for stream, pipe in enumerate((process.stdout, process.stderr)):
+                        if pipe is not None:
+                            selector.register(pipe, selectors.EVENT_READ, stream)
+
+                    while selector.get_map():
+                        for key, _ in selector.select(timeout=1.0):
+                            data = os.read(key.fd, self.READ_CHUNK_SIZE)
+                            if data:
+                                yield key.data, data
+                            else:
+                                selector.unregister(key.fileobj)
+                        _show_elapsed()
+
+                while True:
+                    try:
+                        process.wait(timeout=1.0)
+                        break
+                    except subprocess.TimeoutExpired:
+                        _show_elapsed()
+            except BaseException:
+                process.kill()
+                raise
+
+            self.returncode = process.returncode
+            if show_timer:
+                sys.stdout.write("\r" + " " * 40 + "\r")  # Clear the line
+                sys.stdout.flush()
+            elapsed = int(time.monotonic() - start)
+            self.logger.debug(f"{desc}... {elapsed}s elapsed")
+
     def run_cmd_with_timer(
         self,
         cmd: List[str],
@@ -271,48 +542,64 @@ class PatchReview(abc.ABC):
             str: Output of running the command (stdout + stderr).
                  To skip stdout/stderr, pass stdout/stderr=subprocess.DEVNULL.
         """
-        show_timer = self.logger.isEnabledFor(logging.INFO)
-        start = time.time()
-
-        with subprocess.Popen(
-            cmd,
-            cwd=cwd,
-            stdout=stdout,
-            stderr=stderr,
-            text=True,
-            bufsize=1,
-            universal_newlines=True,
-            **kwargs,
-        ) as process:
-            output = ""
-            while True:
-                try:
-                    _stdout, _stderr = process.communicate(timeout=5)
-                    if _stdout:
-                        self.logger.debug(_stdout)
-                        output += _stdout
-                    if _stderr:
-                        self.logger.debug(_stderr)
-                        output += _stderr
-
-                    if show_timer:
-                        sys.stdout.write("\r" + " " * 40 + "\r")  # Clear the line
-                        sys.stdout.flush()
-                    elapsed = int(time.time() - start)
-                    self.logger.debug(f"{desc}... {elapsed}s elapsed")
-                    break
-
-                except subprocess.TimeoutExpired:
-                    elapsed = int(time.time() - start)
-                    if show_timer:
-                        sys.stdout.write(f"\r{desc}... {elapsed}s elapsed")
-                        sys.stdout.flush()
-
-                except Exception:
-                    process.kill()
-                    raise
-
-            return output  # TODO return a tuple of (stdout, stderr) if both are needed
+        outputs = (bytearray(), bytearray())
+        for stream, data in self._stream_cmd_output(
+            cmd, desc, cwd, stdout, stderr, **kwargs
+        ):
+            outputs[stream].extend(data)
+
+        # stdout comes before stderr, as when both were read at exit
+        log_output = self.logger.isEnabledFor(logging.DEBUG)
+        output: list[str] = []
+        for data in outputs:
+            if data:
+                text = _decode_output(data)
+                if log_output:
+                    self.logger.debug(text)
+                output.append(text)
+
+        # TODO return a tuple of (stdout, stderr) if both are needed
+        return "".join(output)
+
+    def run_cmd_lines(
+        self,
+        cmd: List[str],
+        desc: str,
+        cwd: str,
+        stdout: int | None = subprocess.PIPE,
+        stderr: int | None = subprocess.PIPE,
+        **kwargs: Any,
+    ) -> Iterator[str]:
+        """
+        Like run_cmd_with_timer(), but yields the lines of the output as they
+        are read instead of returning all of it once the command exits, so
+        that callers filtering the output never hold all of it in memory.
+        Lines of stdout and stderr are interleaved in the order they arrive.
+        """
+        log_lines = self.logger.isEnabledFor(logging.DEBUG)
+        # The trailing partial line of each stream
+        pending = (bytearray(), bytearray())
+        for stream, data in self._stream_cmd_output(
+            cmd, desc, cwd, stdout, stderr, **kwargs
+        ):
+            end = data.rfind(b"\n")
+            if end < 0:
+                pending[stream].extend(data)
+                continue
+            pending[stream].extend(data[: end + 1])
+            # Decoded a chunk at a time, a newline never splits a character
+            lines = _decode_output(pending[stream]).splitlines()
+            pending[stream][:] = data[end + 1 :]
+            for line in lines:
+                if log_lines:
+                    self.logger.debug(line)
+                yield line
+
+        for data in pending:
+            for line in _decode_output(data).splitlines():
+                if log_lines:
+                    self.logger.debug(line)
+                yield line
 
     @abc.abstractmethod
     def run(self) -> str:
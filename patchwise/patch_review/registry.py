@@ -0,0 +1,84 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Declarative registry of the available patch reviews.
+
+Review modules are only imported once one of their reviews is selected, so
+this table must be kept in sync with the @register_* decorators applied to
+each review class.
+"""
+
+import importlib
+import sys
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .patch_review import PatchReview
+
+# Review name -> (module path, class name)
+REVIEW_MODULES: dict[str, tuple[str, str]] = {
+    "AiCodeReview": (
+        "patchwise.patch_review.ai_review.ai_code_review",
+        "AiCodeReview",
+    ),
+    "LLMCommitAudit": (
+        "patchwise.patch_review.ai_review.llm_commit_audit",
+        "LLMCommitAudit",
+    ),
+    "Checkpatch": (
+        "patchwise.patch_review.static_analysis.checkpatch",
+        "Checkpatch",
+    ),
+    "Coccicheck": (
+        "patchwise.patch_review.static_analysis.coccicheck",
+        "Coccicheck",
+    ),
+    "DtCheck": (
+        "patchwise.patch_review.static_analysis.dt_check",
+        "DtCheck",
+    ),
+    "DtbsCheck": (
+        "patchwise.patch_review.static_analysis.dtbs_check",
+        "DtbsCheck",
+    ),
+    "Sparse": (
+        "patchwise.patch_review.static_analysis.sparse",
+        "Sparse",
+    ),
+}
+
+# Review groups, mirroring the register_*_review decorators
+AVAILABLE_REVIEW_NAMES = frozenset(REVIEW_MODULES)
+LLM_REVIEW_NAMES = frozenset({"AiCodeReview", "LLMCommitAudit"})
+STATIC_ANALYSIS_REVIEW_NAMES = frozenset(
+    {"Checkpatch", "Coccicheck", "DtCheck", "DtbsCheck", "Sparse"}
+)
+SHORT_REVIEW_NAMES = frozenset({"Checkpatch", "Coccicheck", "LLMCommitAudit"})
+LONG_REVIEW_NAMES = frozenset({"AiCodeReview", "DtCheck", "DtbsCheck", "Sparse"})
+
+_resolved_reviews: dict[str, type["PatchReview"]] = {}
+
+
+def _cached_import(module_path: str):
+    """
+    Returns the module from sys.modules when already imported, skipping the
+    import machinery and its import lock.
+    """
+    module = sys.modules.get(module_path)
+    if module is None:
+        module = importlib.import_module(module_path)
+    return module
+
+
+def get_review_class(name: str) -> type["PatchReview"]:
+    """
+    Imports the module defining the named review and returns its class.
+    Resolved classes are cached so each review module is imported only once.
+    """
+    review_cls = _resolved_reviews.get(name)
+    if review_cls is None:
+        module_path, class_name = REVIEW_MODULES[name]
+        review_cls = getattr(_cached_import(module_path), class_name)
+        _resolved_reviews[name] = review_cls
+    return review_cls
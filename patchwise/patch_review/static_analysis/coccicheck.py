@@ -1,8 +1,11 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
+import concurrent.futures
+import copy
 import os
 import re
+from typing import Iterator
 
 from patchwise.patch_review.decorators import (
     register_short_review,
@@ -11,30 +14,36 @@ from patchwise.patch_review.decorators import (
 
 from .static_analysis import StaticAnalysis
 
+# file:line:column-column: message
+REPORT_LINE_RE = re.compile(r"^([^:]+):\d+:\d+-\d+:.*")
+
 
 @register_static_analysis_review
 @register_short_review
 class Coccicheck(StaticAnalysis):
     DEPENDENCIES = []
+    # Directories checked at once, so that one's spatch startup and cleanup
+    # overlap with another's checks
+    MAX_PARALLEL_DIRECTORIES = 2
 
-    def _run_coccicheck(self, directory: str) -> str:
-        coccicheck_output = super().run_cmd_with_timer(
+    def _run_coccicheck(self, directory: str, jobs: int) -> Iterator[str]:
+        return super().run_cmd_lines(
             [
                 "make",
                 f"O={self.build_dir}",
-                f"-j{os.cpu_count()}",
+                f"-j{jobs}",
                 "ARCH=arm64",
                 "LLVM=1",
                 "-s",
                 "coccicheck",
                 f"M={directory}",
                 "MODE=report",
+                # Shared by concurrent makes, which is fine since it is /dev/null
                 f"DEBUG_FILE={self.symlink_path}",  # if hasattr(self, 'symlink_path') else "DEBUG_FILE=/dev/null",
             ],
             cwd=str(self.repo.working_tree_dir),
             desc="coccicheck running",
         )
-        return coccicheck_output
 
     def setup(self) -> None:
         # Create symlink /tmp/{package_name}_null -> /dev/null
@@ -42,41 +51,72 @@ class Coccicheck(StaticAnalysis):
         package_name = __package__ or "coccicheck"
         self.symlink_path = f"/tmp/{package_name}_null"
         target = "/dev/null"
+        # Reviews of other commits may be setting up the same symlink concurrently
+        if (
+            os.path.islink(self.symlink_path)
+            and os.readlink(self.symlink_path) == target
+        ):
+            return
         if os.path.islink(self.symlink_path) or os.path.exists(self.symlink_path):
             os.remove(self.symlink_path)
-        os.symlink(target, self.symlink_path)
+        try:
+            os.symlink(target, self.symlink_path)
+        except FileExistsError:
+            pass
+
+    def _check_directory(
+        self, directory: str, modified_files: set[str], jobs: int
+    ) -> list[str]:
+        """Returns the coccicheck reports of directory on the modified files."""
+        self.logger.debug(f"Running coccicheck on directory: '{directory}'")
+        output: list[str] = []
+        # Each report line is matched as coccicheck prints it
+        for line in self._run_coccicheck(directory, jobs):
+            # Most of make's output cannot be a report line, skip it
+            # without running the regex
+            if line.count(":") < 3:
+                continue
+            match = REPORT_LINE_RE.match(line)
+            if not match:
+                continue
+            file_path = match.group(1)
+            if file_path.startswith("./"):
+                file_path = file_path[2:]
+            # Kernel paths are always POSIX
+            full_path = f"{directory}/{file_path}"
+            if full_path in modified_files:
+                output.append(line + "\n")
+        if self.returncode != 0:
+            self.logger.warning(
+                f"coccicheck on '{directory}' failed with exit status {self.returncode}"
+            )
+        return output
 
     def run(self) -> str:
         # TODO make sure that setup() runs in order for run() to run
         self.logger.debug(f"Running cocci_check")
-        output = ""
-        modified_files = set(self.commit.stats.files.keys())
-        line_re = re.compile(r"^([^:]+):\d+:\d+-\d+:.*")
+        modified_files = set(self.modified_files)
 
         directories: set[str] = set()
-        for item in self.commit.stats.files:
-            dir_path = os.path.dirname(item)
+        for item in modified_files:
+            dir_path = item.rpartition("/")[0]
             if dir_path:
                 directories.add(dir_path)
         self.logger.debug(f"Directories containing modified files: {directories}")
+        if not directories:
+            return ""
 
-        for directory in directories:
-            self.logger.debug(f"Running coccicheck on directory: '{directory}'")
-            cur_output = self._run_coccicheck(directory)
-            if not cur_output:
-                self.logger.debug(f"No coccicheck output for {directory}, skipping")
-                continue
+        # The cores are shared between the makes running at once
+        workers = min(self.MAX_PARALLEL_DIRECTORIES, len(directories))
+        jobs = max(1, self.make_jobs // workers)
 
-            self.logger.debug(f"Coccicheck output for {directory}:\n{cur_output}")
-            for line in cur_output.splitlines():
-                match = line_re.match(line)
-                if not match:
-                    continue
-                file_path = match.group(1)
-                if file_path.startswith("./"):
-                    file_path = file_path[2:]
-                full_path = os.path.join(directory, file_path)
-                if full_path in modified_files:
-                    output += line + "\n"
+        def _check(directory: str) -> list[str]:
+            # Each make runs on a copy of the review, which records the exit
+            # status of its own command, and only a lone make draws the timer
+            review = copy.copy(self)
+            review.show_timer = workers == 1
+            return review._check_directory(directory, modified_files, jobs)
 
-        return output
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            outputs = executor.map(_check, directories)
+            return "".join(line for output in outputs for line in output)
@@ -1,7 +1,6 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
-import os
 from pathlib import Path
 
 from git.objects.commit import Commit
@@ -24,13 +23,14 @@ class DtCheck(StaticAnalysis):
     """
 
     DEPENDENCIES = []
+    DT_CHECKER_FLAGS = "-m"
 
     def __make_refcheckdocs(self) -> str:
         self.logger.debug("Making refcheckdocs")
         output = super().run_cmd_with_timer(
             [
                 "make",
-                f"-j{os.cpu_count()}",
+                f"-j{self.make_jobs}",
                 "-s",
                 f"O={self.build_dir}",
                 "ARCH=arm",
@@ -47,16 +47,18 @@ class DtCheck(StaticAnalysis):
         output = super().run_cmd_with_timer(
             cmd=[
                 "make",
-                f"-j{os.cpu_count()}",
+                f"-j{self.make_jobs}",
                 "-s",
                 f"O={self.build_dir}",
                 "ARCH=arm",
                 "LLVM=1",
-                "DT_CHECKER_FLAGS=-m",
+                *self.compiler_args(),
+                f"DT_CHECKER_FLAGS={self.DT_CHECKER_FLAGS}",
                 "dt_binding_check",
             ],
             cwd=str(self.repo.working_tree_dir),
             desc="dt_binding_check",
+            env=self.make_env(),
         )
         return output.strip()
 
@@ -66,43 +68,51 @@ class DtCheck(StaticAnalysis):
         unique_lines = current_lines - last_lines
         return "\n".join(unique_lines)
 
+    def __log_paths(self, commit: Commit) -> tuple[Path, Path]:
+        logs_dir = Path(SANDBOX_PATH) / "dt-checker-logs"
+        return (
+            logs_dir / f"{commit.hexsha}_refcheckdocs.log",
+            logs_dir
+            / f"{commit.hexsha}_dt_binding_check-{self.cache_key(self.DT_CHECKER_FLAGS)}.log",
+        )
+
     def __get_dt_checker_logs(self, commit: Commit) -> tuple[str, str]:
         # TODO Extract yamllint warnings/errors
         """
         Retrieves and caches dt_checker logs for a given kernel tree and SHA.
         Logs are saved to files in the 'dt-checker-logs' folder.
         """
-        logs_dir = Path(SANDBOX_PATH) / "dt-checker-logs"
-        refcheckdocs_log_path = logs_dir / f"{commit.hexsha}_refcheckdocs.log"
-        dt_binding_check_log_path = logs_dir / f"{commit.hexsha}_dt_binding_check.log"
+        refcheckdocs_log_path, dt_binding_check_log_path = self.__log_paths(commit)
 
         self.logger.debug(f"Running dt-checker on: {commit.hexsha}")
 
-        logs_dir.mkdir(parents=True, exist_ok=True)
+        refcheckdocs_log_path.parent.mkdir(parents=True, exist_ok=True)
 
-        if dt_binding_check_log_path.exists() and refcheckdocs_log_path.exists():
-            self.logger.debug(
-                f"Using cached dt_binding_check logs for: {commit.hexsha}"
-            )
-        else:
+        # Each log is cached on its own, so only a missing one is rebuilt
+        refcheckdocs_logs = self._cache_get(refcheckdocs_log_path)
+        dt_binding_check_logs = self._cache_get(dt_binding_check_log_path)
+        if refcheckdocs_logs is None or dt_binding_check_logs is None:
             self.apply_patches([commit])
+            super().make_config()  # TODO change back to _make_allmodconfig
+        if refcheckdocs_logs is None:
             refcheckdocs_logs = self.__make_refcheckdocs()
             refcheckdocs_log_path.write_text(refcheckdocs_logs)
             self.logger.debug(f"Saved refcheckdocs logs to {refcheckdocs_log_path}")
+        if dt_binding_check_logs is None:
             dt_binding_check_logs = self.__make_dt_binding_check()
             dt_binding_check_log_path.write_text(dt_binding_check_logs)
             self.logger.debug(
                 f"Saved dt_binding_check logs to {dt_binding_check_log_path}"
             )
 
-        return refcheckdocs_log_path.read_text(), dt_binding_check_log_path.read_text()
+        return refcheckdocs_logs, dt_binding_check_logs
 
     def setup(self) -> None:
         self.logger.debug("Setting up dt-check")
         self.dt_files = [
             f
-            for f in self.commit.stats.files.keys()
-            if str(f).startswith("Documentation") and str(f).endswith(".yaml")
+            for f in self.modified_files
+            if f.startswith("Documentation") and f.endswith(".yaml")
         ]
         if not self.dt_files:
             self.logger.debug("No modified dt files")
@@ -119,9 +129,16 @@ class DtCheck(StaticAnalysis):
 
         self.logger.debug(f"Preparing kernel tree for dt checks")
         # super().clean_tree()
-        super().make_config()  # TODO change back to _make_allmodconfig
-        base_refcheck, base_binding = self.__get_dt_checker_logs(self.base_commit)
-        patch_refcheck, patch_binding = self.__get_dt_checker_logs(self.commit)
+        # The base commit is usually cached from reviewing it as a patch
+        # commit, only build both at once when it is not
+        base_logs, patch_logs = self.run_on_base_and_commit(
+            DtCheck.__get_dt_checker_logs,
+            parallel=not all(
+                path.exists() for path in self.__log_paths(self.base_commit)
+            ),
+        )
+        base_refcheck, base_binding = base_logs
+        patch_refcheck, patch_binding = patch_logs
 
         refcheckdocs_output = self.__get_unique_lines(base_refcheck, patch_refcheck)
         dt_binding_check_output = self.__get_unique_lines(base_binding, patch_binding)
@@ -1,9 +1,10 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
-import os
 from pathlib import Path
 
+from git.objects.commit import Commit
+
 from patchwise import SANDBOX_PATH
 from patchwise.patch_review.decorators import (
     register_long_review,
@@ -23,36 +24,49 @@ class DtbsCheck(StaticAnalysis):
 
     DEPENDENCIES = []
 
-    def __run_dtbs_check(self, sha: str) -> str:
+    ARCH = "arm64"  # TODO loop through both arm and arm64
+    CFG_OPTS = [
+        "CONFIG_ARM64_ERRATUM_843419=n",
+        "CONFIG_ARM64_USE_LSE_ATOMICS=n",
+        "CONFIG_BROKEN_GAS_INST=n",
+    ]
+
+    def __log_path(self, commit: Commit) -> Path:
+        key = self.cache_key(commit.hexsha, self.ARCH, ",".join(self.CFG_OPTS))
+        return Path(SANDBOX_PATH) / "dtbs-logs" / f"build-dtbs-{key}.log"
+
+    def __run_dtbs_check(self, commit: Commit) -> str:
         kernel_tree = str(self.repo.working_tree_dir)
-        log_dir = Path(SANDBOX_PATH) / "dtbs-logs"
-        log_dir.mkdir(parents=True, exist_ok=True)
-        logfile = log_dir / f"build-dtbs-{sha}.log"
-        cfg_opts = [
-            "CONFIG_ARM64_ERRATUM_843419=n",
-            "CONFIG_ARM64_USE_LSE_ATOMICS=n",
-            "CONFIG_BROKEN_GAS_INST=n",
-        ]
-
-        arch = "arm64"  # TODO loop through both arm and arm64
+        arch = self.ARCH
+        cfg_opts = self.CFG_OPTS
+        logfile = self.__log_path(commit)
+        logfile.parent.mkdir(parents=True, exist_ok=True)
+        dtbs_check_output = self._cache_get(logfile)
+        if dtbs_check_output is not None:
+            return dtbs_check_output
+
+        self.apply_patches([commit])
         super().make_config(
             arch=arch, extra_args=cfg_opts
         )  # TODO use _make_allmodconfig
         dtbs_check_output = super().run_cmd_with_timer(
             cmd=[
                 "make",
-                f"-j{os.cpu_count()}",
+                f"-j{self.make_jobs}",
                 "-s",
                 f"O={self.build_dir}",
                 f"ARCH={arch}",
                 "LLVM=1",
+                *self.compiler_args(),
                 "dtbs_check",
             ]
             + cfg_opts,
             cwd=kernel_tree,
             desc=f"dtbs_check",
+            env=self.make_env(),
         )
-        # logfile.write_text(dtbs_check_output) # TODO log to file and check for cache
+        logfile.write_text(dtbs_check_output)
+        self.logger.debug(f"Saved dtbs_check logs to {logfile}")
         return dtbs_check_output
 
     def __get_unique_lines(self, baseline_log: str, new_log: str) -> str:
@@ -67,7 +81,7 @@ class DtbsCheck(StaticAnalysis):
     def run(self) -> str:
         self.logger.debug("Running dtbs_check analysis")
 
-        modified_files = [str(f) for f in self.commit.stats.files.keys()]
+        modified_files = self.modified_files
         dt_files = [f for f in modified_files if f.endswith((".yaml", ".dts", ".dtsi"))]
         if not dt_files:
             self.logger.debug("No modified DT schema files found, skipping dtbs_check")
@@ -75,14 +89,14 @@ class DtbsCheck(StaticAnalysis):
         self.logger.debug(f"Modified DT files: {dt_files}")
 
         self.logger.debug(
-            f"Running dtbs_check for base commit: {self.base_commit.message}"
+            f"Running dtbs_check for base commit {self.base_commit.hexsha} and patch commit {self.commit.hexsha}"
+        )
+        # The base commit is usually cached from reviewing it as a patch
+        # commit, only build both at once when it is not
+        baseline_output, patch_output = self.run_on_base_and_commit(
+            DtbsCheck.__run_dtbs_check,
+            parallel=not self.__log_path(self.base_commit).exists(),
         )
-        self.apply_patches([self.base_commit])
-        baseline_output = self.__run_dtbs_check(self.base_commit.hexsha)
-
-        self.logger.debug(f"Running dtbs_check for patch commit: {self.commit.message}")
-        self.apply_patches([self.commit])
-        patch_output = self.__run_dtbs_check(self.commit.hexsha)
 
         diff_output = self.__get_unique_lines(baseline_output, patch_output)
         if not diff_output:
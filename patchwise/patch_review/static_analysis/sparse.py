@@ -13,13 +13,17 @@ from patchwise.patch_review.decorators import (
     register_long_review,
     register_static_analysis_review,
 )
-from patchwise.patch_review.patch_review import Dependency
+from patchwise.patch_review.patch_review import Dependency, LLVMDependency
 
 from .static_analysis import StaticAnalysis
 
 MINIMUM_CLANG_VERSION = 14
 MINIMUM_SPARSE_VERSION = "0.6.4"
 
+SPARSE_LOG_RE = re.compile(
+    r"(?P<filepath>.+):(?P<linenum>\d+):(?P<column>\d+): (?P<message>.+)"
+)
+
 
 class SparseDependency(Dependency):
     # TODO if installing to SANDBOX_PATH and the version still does not work, the user will need to manually clear the SANDBOX_PATH folder because SANDBOX_PATH is at the start of the PATH
@@ -68,15 +72,15 @@ class Sparse(StaticAnalysis):
     """
 
     DEPENDENCIES = [
-        Dependency(
+        LLVMDependency(
             name="llvm-config",
             min_version=MINIMUM_CLANG_VERSION,
         ),
-        Dependency(
+        LLVMDependency(
             name="clang",
             min_version=MINIMUM_CLANG_VERSION,
         ),
-        Dependency(
+        LLVMDependency(
             name="ld.lld",
             min_version=MINIMUM_CLANG_VERSION,
         ),
@@ -89,6 +93,46 @@ class Sparse(StaticAnalysis):
         ),
     ]
 
+    def __get_blamed_lines(self, filepath: str, linenums: set[int]) -> set[int]:
+        """
+        Returns the lines among linenums that are blamed on a commit between
+        the base commit and the commit under review.
+        """
+        try:
+            blame_output = self.repo.git.blame(
+                "--line-porcelain",
+                *(f"-L{linenum},+1" for linenum in sorted(linenums)),
+                f"{self.base_commit}..{self.commit}",
+                "--",
+                filepath,
+            )
+        except GitCommandError:
+            if len(linenums) == 1:
+                # File or line not found in the commit
+                return set()
+            # Blame the lines one by one so that a bad line only drops itself
+            return set().union(
+                *(self.__get_blamed_lines(filepath, {linenum}) for linenum in linenums)
+            )
+
+        # Every line is a "<sha> <orig line> <final line>" header, commit
+        # details that include "boundary" for lines older than the base
+        # commit, and the line's content prefixed by a tab
+        blamed: set[int] = set()
+        final_linenum = None
+        boundary = False
+        for blame_line in blame_output.split("\n"):
+            if blame_line.startswith("\t"):
+                if final_linenum is not None and not boundary:
+                    blamed.add(final_linenum)
+                final_linenum = None
+                boundary = False
+            elif final_linenum is None:
+                final_linenum = int(blame_line.split(" ")[2])
+            elif blame_line == "boundary":
+                boundary = True
+        return blamed
+
     def setup(self) -> None:
         pass
 
@@ -101,65 +145,89 @@ class Sparse(StaticAnalysis):
         logger.debug("Running defconfig")
         super().make_config(arch="arm64")  # TODO change back to _make_allmodconfig
 
-        sparse_log_pattern = re.compile(
-            r"(?P<filepath>.+):(?P<linenum>\d+):(?P<column>\d+): (?P<message>.+)"
-        )
-
-        # TODO use modified_files = set(self.commit.stats.files.keys())
-        diff = self.repo.git.diff(
-            "--name-only", f"{self.base_commit}..{self.commit}"
-        ).splitlines()
-        files_changed = [os.path.join(kernel_tree, f.strip()) for f in diff]
+        files_changed = {os.path.join(kernel_tree, f) for f in self.modified_files}
         for f in files_changed:
             logger.debug(f"Touching {f}")
-            subprocess.run(["touch", f], check=True)
+            try:
+                os.utime(f)
+            except FileNotFoundError:
+                # Deleted by the commit, there is nothing left to recheck
+                logger.debug(f"{f} does not exist, not touching it")
+
+        # Only warnings in the modified files are reported, so unless a header
+        # was modified only their objects need to be built; -k keeps going
+        # past objects that do not build in this config
+        targets = self.modified_object_targets()
+        if targets is None:
+            targets = []
+        elif targets:
+            targets = ["-k", *targets]
+        else:
+            logger.debug("No modified sources to check")
+            return ""
 
         logger.debug("Running sparse check")
-        sparse_warnings = super().run_cmd_with_timer(
+        sparse_output = super().run_cmd_lines(
             [
                 "make",
                 f"O={self.build_dir}",
-                f"-j{os.cpu_count()}",
+                f"-j{self.make_jobs}",
                 "ARCH=arm64",
                 "LLVM=1",
+                *self.compiler_args(),
                 "C=1",
                 "-s",
                 "CHECK=sparse",
+                *targets,
             ],
             cwd=str(self.repo.working_tree_dir),
             desc="sparse check",
+            env=self.make_env(),
             # stdout=subprocess.DEVNULL,
         )
 
-        output = ""
-        for line in sparse_warnings.splitlines():
-            match = re.match(sparse_log_pattern, line)
+        # Sparse warnings in the changed files, with their line numbers,
+        # filtered as make prints them
+        warnings: list[tuple[str, str, int]] = []
+        # Whether each warned path is a changed file, most have many warnings
+        is_changed: dict[str, bool] = {}
+        for line in sparse_output:
+            # Cheaply skip lines that cannot be a warning before the regex
+            if ": " not in line:
+                continue
+            match = SPARSE_LOG_RE.match(line)
             # Avoids make's logs and only processes sparse warnings
             if match:
                 filepath = match.group("filepath")
-                linenum = match.group("linenum")
-                # The git blame call below is expensive; run it only on files changed
-                if os.path.join(kernel_tree, filepath.strip()) not in files_changed:
-                    continue
-
-                try:
-                    blame_output = self.repo.git.blame(
-                        f"-L{linenum},+1",
-                        f"{self.base_commit}..{self.commit}",
-                        "-l",
-                        "--",
-                        filepath,
+                # git blame is expensive; run it only on files changed
+                changed = is_changed.get(filepath)
+                if changed is None:
+                    changed = (
+                        os.path.join(kernel_tree, filepath.strip()) in files_changed
                     )
-                    # Only include if the current commit is blamed
-                    if not blame_output.startswith("^"):
-                        # Strip kernel_tree prefix from the line's filepath
-                        if line.startswith(kernel_tree + "/"):
-                            stripped_line = line[len(kernel_tree) + 1 :]
-                        else:
-                            stripped_line = line
-                        output += stripped_line + "\n"
-                except GitCommandError:
-                    # File not found in the commit
+                    is_changed[filepath] = changed
+                if not changed:
                     continue
-
-        return output
+                warnings.append((line, filepath, int(match.group("linenum"))))
+
+        # One git blame per file covers all of its warned lines
+        linenums_by_file: dict[str, set[int]] = {}
+        for _, filepath, linenum in warnings:
+            linenums_by_file.setdefault(filepath, set()).add(linenum)
+        blamed_by_file = {
+            filepath: self.__get_blamed_lines(filepath, linenums)
+            for filepath, linenums in linenums_by_file.items()
+        }
+
+        output: list[str] = []
+        for line, filepath, linenum in warnings:
+            # Only include if the current commit is blamed
+            if linenum in blamed_by_file[filepath]:
+                # Strip kernel_tree prefix from the line's filepath
+                if line.startswith(kernel_tree + "/"):
+                    stripped_line = line[len(kernel_tree) + 1 :]
+                else:
+                    stripped_line = line
+                output.append(stripped_line + "\n")
+
+        return "".join(output)
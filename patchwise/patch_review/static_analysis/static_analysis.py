@@ -1,9 +1,33 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Callable, Literal, TypeVar
 
-from patchwise.patch_review.patch_review import PatchReview
+from git.objects.commit import Commit
+
+from patchwise import SANDBOX_PATH
+from patchwise.patch_review.kernel_tree import create_base_worktree
+from patchwise.patch_review.patch_review import (
+    BUILD_DIR,
+    NPROC,
+    PatchReview,
+    get_kernel_repo,
+)
+
+T = TypeVar("T")
+
+
+@functools.cache
+def _find_ccache() -> str | None:
+    return shutil.which("ccache")
 
 
 class StaticAnalysis(PatchReview):
@@ -14,35 +38,121 @@ class StaticAnalysis(PatchReview):
     tools. Subclasses should override the `run` method.
     """
 
-    def clean_tree(self, arch: str = "arm"):
-        self.logger.debug("Cleaning kernel tree")
+    # Two kernel builds at once only pay off when each still gets enough cores
+    MAX_BUILD_WORKTREES = min(2, max(1, NPROC // 8))
+    # Parallel jobs of each make, split between builds that run at once
+    make_jobs: int = NPROC
+    # Written next to .config with the tree it was made for
+    CONFIG_MARKER = ".patchwise-config"
+    # Compiles go through ccache when it is installed, unless --no-ccache
+    use_ccache = True
+    # Shared by all builds, so objects are reused across commits and runs. A
+    # CCACHE_DIR set in the environment takes precedence, e.g. to share a
+    # tmpfs cache between several containers.
+    CCACHE_DIR = Path(os.environ.get("CCACHE_DIR", SANDBOX_PATH / "ccache"))
+
+    def clean_tree(
+        self, arch: str = "arm", level: Literal["clean", "mrproper"] = "clean"
+    ):
+        """
+        "clean" removes the objects of the build directory but keeps its
+        .config, so the next build does not have to configure again.
+        "mrproper" removes every generated file from the kernel tree itself.
+        """
+        self.logger.debug(f"Cleaning kernel tree ({level})")
+        out_args = [f"O={self.build_dir}"] if level == "clean" else []
         self.run_cmd_with_timer(
             [
                 "make",
-                f"-j{os.cpu_count()}",
+                *out_args,
+                f"-j{self.make_jobs}",
                 "-s",
                 "ARCH=" + arch,
                 "LLVM=1",
-                "mrproper",
+                level,
             ],
             cwd=str(self.repo.working_tree_dir),
             desc="Cleaning tree",
+            stdout=subprocess.DEVNULL,
         )
 
+    def compiler_args(self) -> list[str]:
+        """Make variables selecting the compilers of builds that compile."""
+        if not self.use_ccache or _find_ccache() is None:
+            return []
+        return ["CC=ccache clang", "HOSTCC=ccache clang"]
+
+    def make_env(self) -> dict[str, str] | None:
+        """
+        The environment of builds that compile, or None to inherit it. ccache
+        hashes paths relative to the worktree and ignores the build directory,
+        which differs between commits and configs, and the build timestamp is
+        pinned, so objects hit the cache across worktrees, configs and runs.
+        """
+        if not self.compiler_args():
+            return None
+        return {
+            **os.environ,
+            "CCACHE_DIR": str(self.CCACHE_DIR),
+            "CCACHE_BASEDIR": str(self.repo.working_tree_dir),
+            "CCACHE_NOHASHDIR": "1",
+            "KBUILD_BUILD_TIMESTAMP": "Thu Jan  1 00:00:00 UTC 1970",
+        }
+
+    def modified_object_targets(self) -> list[str] | None:
+        """
+        Returns the objects built from the sources modified by the commit, so
+        that a build can be limited to them without linking anything. Returns
+        None if the commit modifies a header, since the files including it
+        are unknown and only a full build covers them.
+        """
+        targets: list[str] = []
+        for path in self.modified_files:
+            stem, _, ext = path.rpartition(".")
+            if ext == "h":
+                return None
+            if ext in ("c", "S"):
+                targets.append(f"{stem}.o")
+        return targets
+
     def make_config(
         self,
         config_type: str = "defconfig",
         arch: str = "arm",
         extra_args: list[str] = [],
     ) -> None:
+        """
+        Configures the kernel build and points build_dir at a directory kept
+        for that configuration, so that reviews configuring the kernel
+        differently do not overwrite each other's .config. A directory that
+        is already configured for the current sources is not configured again.
+        """
+        key = self.cache_key(config_type, arch, *extra_args)
+        self.build_dir = self.build_root / f"{arch}-{config_type}-{key[:12]}"
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        # Every apply_patches() cherry-picks a new commit, so the tree is
+        # what tells whether the sources are the same
+        marker = self.build_dir / self.CONFIG_MARKER
+        tree = self.repo.head.commit.tree.hexsha
+        try:
+            configured = marker.read_text() == tree
+        except FileNotFoundError:
+            configured = False
+        if configured and (self.build_dir / ".config").exists():
+            self.logger.debug(f"{config_type} is already made in {self.build_dir}")
+            return
+        # An interrupted run must not leave the directory marked as configured
+        marker.unlink(missing_ok=True)
+
         self.logger.debug(f"Making {config_type}")
         cmd = [
             "make",
             f"O={self.build_dir}",
-            f"-j{os.cpu_count()}",
+            f"-j{self.make_jobs}",
             "-s",
             "ARCH=" + arch,
             "LLVM=1",
+            *self.compiler_args(),
             config_type,
         ]
         if extra_args:
@@ -51,4 +161,73 @@ class StaticAnalysis(PatchReview):
             cmd,
             cwd=str(self.repo.working_tree_dir),
             desc=config_type,
+            env=self.make_env(),
+            # Only errors of the config step are worth logging
+            stdout=subprocess.DEVNULL,
         )
+        # A failed make can still leave a .config behind
+        if self.returncode == 0:
+            marker.write_text(tree)
+        else:
+            self.logger.warning(
+                f"make {config_type} failed with exit status {self.returncode}"
+            )
+
+    @staticmethod
+    def cache_key(*parts: str) -> str:
+        """Returns a file name safe key identifying the given parts."""
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def _cache_get(self, path: Path) -> str | None:
+        """Returns the contents of a cached log, or None if it was never written."""
+        try:
+            output = path.read_text()
+        except FileNotFoundError:
+            return None
+        self.logger.debug(f"Using cached log {path}")
+        return output
+
+    def _base_review(self) -> "StaticAnalysis":
+        """
+        Returns a copy of this review that builds in the base worktree, with a
+        build directory of its own, so that it can run alongside this one. The
+        directory is per worktree, since concurrently reviewed commits can
+        share a parent.
+        """
+        base_review = copy.copy(self)
+        base_review.kernel_path = create_base_worktree(self.repo, self.kernel_path)
+        base_review.repo = get_kernel_repo(base_review.kernel_path)
+        # Commits read objects through the Repo they came from, which is not
+        # thread safe, so the copy gets its own
+        base_review.commit = base_review.repo.commit(self.commit.hexsha)
+        base_review.base_commit = base_review.repo.commit(self.base_commit.hexsha)
+        base_review.build_root = (
+            BUILD_DIR / f"{self.base_commit.hexsha}_base-{base_review.kernel_path.name}"
+        )
+        base_review.build_dir = base_review.build_root
+        base_review.build_dir.mkdir(parents=True, exist_ok=True)
+        return base_review
+
+    def run_on_base_and_commit(
+        self, fn: Callable[["StaticAnalysis", Commit], T], parallel: bool = True
+    ) -> tuple[T, T]:
+        """
+        Returns fn(review, base_commit) and fn(review, commit). If parallel is
+        set and the host has the cores for it, the base commit is handled in
+        its own worktree concurrently with the commit.
+        """
+        if not parallel or self.MAX_BUILD_WORKTREES < 2:
+            return fn(self, self.base_commit), fn(self, self.commit)
+
+        base_review = self._base_review()
+        # The two builds share the cores rather than each one using all of
+        # them, which would only oversubscribe the host
+        make_jobs = self.make_jobs
+        base_review.make_jobs = self.make_jobs = max(1, make_jobs // 2)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                base_future = executor.submit(fn, base_review, base_review.base_commit)
+                patch_future = executor.submit(fn, self, self.commit)
+                return base_future.result(), patch_future.result()
+        finally:
+            self.make_jobs = make_jobs
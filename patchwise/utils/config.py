@@ -1,46 +1,194 @@
 # Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
 # SPDX-License-Identifier: BSD-3-Clause
 
-from platformdirs import user_config_dir
-from patchwise import PACKAGE_PATH
+import functools
+import hashlib
+import json
+import os
+from platformdirs import user_cache_dir, user_config_dir
+from patchwise import PACKAGE_NAME, PACKAGE_PATH
 from pathlib import Path
-from typing import Dict, Any, cast
-import yaml
+from types import MappingProxyType
+from typing import Dict, Any
 
 CONFIG_DIR = Path(user_config_dir())
 DEFAULT_CONFIG_PATH = PACKAGE_PATH / "default_config.yaml"
+# Shipped JSON copy of the default config, identified by the SHA-256 of the
+# YAML it was made from. Regenerate it with write_default_config_copy()
+# whenever default_config.yaml changes; a stale copy is only ignored.
+DEFAULT_CONFIG_COPY_PATH = PACKAGE_PATH / "default_config.json"
 USER_CONFIG_PATH = CONFIG_DIR / "patchwise_config.yaml"
+# JSON copies of parsed configs
+CONFIG_CACHE_DIR = Path(user_cache_dir(PACKAGE_NAME)) / "config"
 
 
-def read_from_config(path: Path) -> Dict[str, Any]:
-    with open(path, "r") as file:
-        config_dict = yaml.safe_load(file)
+@functools.cache
+def _yaml_loader() -> type:
+    """
+    Imports yaml and picks its loader once. The libyaml based loader is much
+    faster where PyYAML was built with it.
+    """
+    import yaml
+
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _parse_yaml(data: bytes) -> Any:
+    import yaml
+
+    return yaml.load(data, Loader=_yaml_loader())
+
+
+def _json_copy(config: Any) -> Any:
+    """
+    Returns config as JSON would load it back, or None if that differs from
+    config. JSON cannot represent every YAML value, e.g. non-string keys, and
+    a copy that loads differently would change the config between runs.
+    """
+    try:
+        copy = json.loads(json.dumps(config))
+    except (TypeError, ValueError, RecursionError):
+        return None
+    return copy if copy == config else None
+
+
+def _load_shipped_copy(data: bytes) -> Any:
+    """Returns the shipped copy of the default config if it was made from data."""
+    try:
+        shipped = json.loads(DEFAULT_CONFIG_COPY_PATH.read_bytes())
+        if shipped["sha256"] == hashlib.sha256(data).hexdigest():
+            return shipped["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_default_config_copy() -> None:
+    """Writes the shipped JSON copy of default_config.yaml."""
+    data = DEFAULT_CONFIG_PATH.read_bytes()
+    config = _parse_yaml(data)
+    if _json_copy(config) is None:
+        raise ValueError(f"{DEFAULT_CONFIG_PATH} cannot be represented as JSON")
+    DEFAULT_CONFIG_COPY_PATH.write_text(
+        json.dumps(
+            {"sha256": hashlib.sha256(data).hexdigest(), "config": config}, indent=2
+        )
+        + "\n"
+    )
+
+
+def _load_config(path: Path, mtime_ns: int, size: int) -> Any:
+    """
+    Loads a YAML config through a JSON copy of it, which is much faster to
+    parse and spares importing yaml. The default config comes with a copy
+    that is checked against the hash of the YAML, as an installed file's
+    mtime says nothing. Other configs are copied into the cache directory
+    on first use, and the copy records the mtime and size of the YAML it was
+    made from. It is only used while they are unchanged, as a restored
+    older YAML can be older than the copy.
+    """
+    data = None
+    if path == DEFAULT_CONFIG_PATH:
+        data = path.read_bytes()
+        config = _load_shipped_copy(data)
+        if config is not None:
+            return config
+
+    path_key = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:12]
+    json_path = CONFIG_CACHE_DIR / f"{path.stem}-{path_key}.json"
+    try:
+        cached = json.loads(json_path.read_bytes())
+        if cached["mtime_ns"] == mtime_ns and cached["size"] == size:
+            return cached["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    config = _parse_yaml(data if data is not None else path.read_bytes())
+
+    if _json_copy(config) is None:
+        return config
+
+    # The cache directory may not be writable, so the copy is best effort
+    tmp_path = json_path.with_name(f".{json_path.name}.{os.getpid()}")
+    try:
+        CONFIG_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(
+            json.dumps({"mtime_ns": mtime_ns, "size": size, "config": config})
+        )
+        os.replace(tmp_path, json_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+
+    return config
+
+
+@functools.lru_cache(maxsize=8)
+def _read_from_config(path: str, mtime_ns: int, size: int) -> MappingProxyType:
+    """
+    Parses a config file. The file's mtime and size are part of the cache
+    key, so an edited file is parsed again.
+    """
+    config_dict = _load_config(Path(path), mtime_ns, size)
 
     if config_dict is None:
-        return {}
+        return MappingProxyType({})
 
     if not isinstance(config_dict, dict):
         raise ValueError(f"Config must be a dictionary, got {type(config_dict)}")
 
-    return cast(Dict[str, Any], config_dict)
+    # Read-only, so that callers cannot modify the cached config
+    return MappingProxyType(config_dict)
 
 
-def parse_config() -> Dict[str, Any]:
-    """
-    Parses both user and default configuration files and returns the union of the two with user taking precedence.
-    """
-    default_options = read_from_config(DEFAULT_CONFIG_PATH)
+def read_from_config(path: Path) -> Dict[str, Any]:
+    stat = path.stat()
+    return dict(_read_from_config(str(path), stat.st_mtime_ns, stat.st_size))
+
+
+def _stat_key(path: Path) -> tuple[int, int] | None:
+    """Identifies the version of a file, or returns None if it does not exist."""
     try:
-        user_options = read_from_config(USER_CONFIG_PATH)
+        stat = path.stat()
     except FileNotFoundError:
-        user_options: Dict[str, Any] = {}
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
 
-    if not user_options:
-        return default_options
 
-    combined_options = {
-        **default_options,
-        **{k: v for k, v in user_options.items() if v is not None},
-    }
+@functools.lru_cache(maxsize=1)
+def _merge_configs(
+    default_key: tuple[int, int] | None, user_key: tuple[int, int] | None
+) -> MappingProxyType:
+    """
+    Merges the user config into the default config. The versions of both
+    files are the cache key, so an edit to either is picked up.
+    """
+    if default_key is None:
+        raise FileNotFoundError(f"Default config not found: {DEFAULT_CONFIG_PATH}")
+    default_options = dict(_read_from_config(str(DEFAULT_CONFIG_PATH), *default_key))
+    # The stat in the cache key already tells whether there is a user config
+    user_options = (
+        _read_from_config(str(USER_CONFIG_PATH), *user_key)
+        if user_key is not None
+        else {}
+    )
+
+    # default_options is a copy of the cached config, so the user's options
+    # can be written straight into it
+    for k, v in user_options.items():
+        if v is not None:
+            default_options[k] = v
 
-    return combined_options
+    return MappingProxyType(default_options)
+
+
+def parse_config(reload: bool = False) -> Dict[str, Any]:
+    """
+    Parses both user and default configuration files and returns the union of the two with user taking precedence.
+    The merged config is cached until either file changes, or reload is set.
+    """
+    if reload:
+        _read_from_config.cache_clear()
+        _merge_configs.cache_clear()
+    return dict(
+        _merge_configs(_stat_key(DEFAULT_CONFIG_PATH), _stat_key(USER_CONFIG_PATH))
+    )